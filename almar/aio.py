@@ -0,0 +1,376 @@
+# coding=utf-8
+"""
+Asyncio engine: async versions of the SRU, Alma and authority clients and
+of the Job runner, so that thousands of record operations can be in flight
+under one event loop. Requires aiohttp (``pip install almar[async]``).
+
+Example::
+
+    async def main():
+        async with create_session() as session:
+            sru = AsyncSruClient(sru_url, cache, session)
+            alma = AsyncAlma('eu', api_key, cache, session)
+            job = AsyncJob(sru=sru, ils=alma, concurrency=20, **job_args(config, args))
+            await job.start()
+
+    asyncio.run(main())
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from .alma import Alma
+from .authorities import Authorities, Vocabulary
+from .cache import namespaced
+from .job import Job, TOO_MANY_RESULTS_MESSAGE
+from .scheduler import RequestScheduler
+from .sru import SruClient, SruPage, TooManyResults
+from .util import INTERACTIVITY_NONE
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+
+def require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError('The asyncio engine requires aiohttp. Install it with "pip install almar[async]"')
+
+
+def create_session(pool_size=100, pool_size_per_host=20, timeout=60):
+    """
+    Create an aiohttp session with a connection pool shared by all the async clients.
+    Must be called from within a running event loop.
+    """
+    require_aiohttp()
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size_per_host),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    )
+
+
+async def imap_ordered(func, items, buffer_size):
+    """
+    Async version of util.imap_ordered: runs the coroutine function `func`
+    for each item, with at most `buffer_size` calls in flight, and yields
+    the results in the same order as the items.
+    """
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= buffer_size:
+                break
+        while pending:
+            result = await pending.popleft()
+            for item in items:
+                pending.append(asyncio.ensure_future(func(item)))
+                break
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def fetch(cache, key, entry, request):
+    """
+    Async version of ResponseCache.fetch, for a key that was not fresh in the cache:
+    `entry` is the expired CacheEntry or None, and `request` an awaitable returning
+    an aiohttp response, sent with the validators from the entry if there is one.
+    """
+    async with await request as response:
+        if response.status == 304 and entry is not None:
+            cache.count('revalidated')
+            cache.set(key, entry.value, etag=entry.etag, last_modified=entry.last_modified)
+            return entry.value
+        response.raise_for_status()
+        content = await response.read()
+    cache.count('misses')
+    cache.set_response(key, content, response.headers)
+    return content
+
+
+class AsyncRequestScheduler(RequestScheduler):
+    """
+    Asyncio version of RequestScheduler: sends requests with an aiohttp session
+    through the token bucket, and retries 429 responses the same way. Waiting for
+    the bucket doesn't block the event loop. Pass the `bucket` of another
+    scheduler to share the rate limit with it.
+
+    :param session: aiohttp.ClientSession
+    """
+
+    def __init__(self, session, rate=25, max_retries=5, backoff_factor=1.0, max_backoff=60,
+                 clock=time.monotonic, sleep=asyncio.sleep, bucket=None):
+        super().__init__(None, rate, max_retries, backoff_factor, max_backoff, clock=clock, bucket=bucket)
+        self.session = session
+        self.sleep = sleep
+
+    async def acquire(self):
+        while True:
+            wait = self.bucket.reserve()
+            if wait == 0:
+                return
+            await self.sleep(wait)
+
+    async def request(self, method, url, **kwargs):
+        """
+        Send a request, and return the aiohttp response, which the caller must release,
+        like with `async with`.
+        """
+        attempt = 0
+        while True:
+            await self.acquire()
+            response = await self.session.request(method, url, **kwargs)
+            if not self.should_retry(response.status, attempt) or not self.is_retryable(await response.text()):
+                return response
+
+            response.release()
+            self.backoff(method, url, response.status, response.headers, attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+class AsyncSruClient(object):
+    """ Asyncio version of SruClient """
+
+    def __init__(self, endpoint_url, cache, session, name=None, cache_time=300, workers=4):
+        require_aiohttp()
+        self.endpoint_url = endpoint_url
+        self.cache = namespaced(cache, 'sru', cache_time)
+        self.session = session
+        self.cache_time = cache_time
+        self.name = name
+        self.workers = workers  # number of pages to fetch concurrently
+        self.record_no = 0  # from last response
+        self.num_records = 0  # from last response
+
+    # Parsing is the same as for the blocking client
+    page_records = SruClient.page_records
+
+    async def request(self, query, start_record):
+        cache_key = '{}:{}'.format(query, start_record)
+        entry = self.cache.lookup(cache_key)
+        if entry is not None and entry.fresh:
+            self.cache.count('hits')
+            return entry.value
+
+        return await fetch(self.cache, cache_key, entry, self.session.get(self.endpoint_url, params={
+            'version': '1.2',
+            'operation': 'searchRetrieve',
+            'startRecord': str(start_record),
+            'maximumRecords': '50',
+            'query': query,
+        }, headers=entry.validators() if entry is not None else {}))
+
+    async def search(self, query):
+        log.debug('SRU search: %s', query)
+        # A searchRetrieve async generator that yields MarcRecord objects
+        page = SruPage(await self.request(query, 1))
+        for record in self.page_records(page):
+            yield record
+
+        start_record = page.next_record_position
+        if start_record is None:
+            return
+
+        page_size = start_record - 1
+        positions = range(start_record, page.num_records + 1, page_size)
+        async for response in imap_ordered(lambda pos: self.request(query, pos), positions, self.workers):
+            for record in self.page_records(SruPage(response)):
+                yield record
+
+
+class AsyncAlma(Alma):
+    """
+    Asyncio version of Alma. Requests are sent through an AsyncRequestScheduler,
+    unless another `scheduler` is given.
+    """
+
+    def __init__(self, api_region, api_key, cache, session, **kwargs):
+        require_aiohttp()
+        if kwargs.get('scheduler') is None:
+            kwargs['scheduler'] = AsyncRequestScheduler(session)
+        super().__init__(api_region, api_key, cache, **kwargs)
+        self.session = session
+
+    async def get_record(self, record_id, fresh=False):
+        """
+        Get a Bib record from Alma
+
+        :type record_id: string
+        :param fresh: Check with Alma even if the record is cached (conditionally, if possible)
+        """
+        entry = self.cache.lookup(record_id)
+        if entry is not None and entry.fresh and not fresh:
+            self.cache.count('hits')
+            record = self.make_bib(record_id, entry.value)
+            record.cached = True
+            return record
+
+        headers = dict(self.headers, **(entry.validators() if entry is not None else {}))
+        content = await fetch(self.cache, record_id, entry,
+                              self.scheduler.get(self.url('/bibs/{mms_id}', mms_id=record_id), headers=headers))
+        return self.make_bib(record_id, content)
+
+    async def put_record(self, record, interactive=False, show_diff=False):
+        """
+        Store a Bib record to Alma. Returns True if the record was stored.
+
+        :param show_diff: bool
+        :param interactive: bool
+        :type record: Bib
+        """
+        if not self.prepare_put(record, interactive, show_diff) or self.dry_run:
+            return False
+
+        if self.preimages is not None:
+            record.preimage = self.preimages.put(record.orig_xml)
+
+        try:
+            async with await self.scheduler.put(self.url('/bibs/{mms_id}', mms_id=record.id),
+                                                data=record.xml(),
+                                                headers=dict(self.headers, **{'Content-Type': 'application/xml'})
+                                                ) as response:
+                response.raise_for_status()
+                content = await response.read()
+            self.cache.delete(record.id)
+            record.init(content)
+            return True
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            msg = '*** Failed to save record %s --- Please try to edit the record manually in Alma ***'
+            log.error(msg, record.id)
+            return False
+
+
+class AsyncVocabulary(Vocabulary):
+    """ Asyncio version of Vocabulary """
+
+    def __init__(self, marc_code, session, id_service_url=None):
+        require_aiohttp()
+        super().__init__(marc_code, id_service_url)
+        self.session = session
+
+    async def authorize_term(self, term, tag):
+        # Lookup term with some id service to get the identifier to use in $0
+
+        if term == '':
+            return {}
+
+        async with self.session.get(self.get_url(term, tag)) as response:
+            text = await response.text()
+            return self.parse_response(response.status, text)
+
+
+class AsyncAuthorities(Authorities):
+    """
+    Asyncio version of Authorities, for use with AsyncVocabulary. Lookups are
+    memoized and cached the same way, with the same cache keys.
+    """
+
+    async def lookup(self, vocab, term, tag):
+        cache_key = self.get_cache_key(vocab, term, tag)
+        response = self.get_response(vocab, cache_key)
+        if response is None:
+            response = vocab.authorize_term(term, tag)
+            if asyncio.iscoroutine(response):  # local vocabularies are not async
+                response = await response
+            self.set_response(vocab, cache_key, response)
+        return response
+
+    async def prefetch(self, concepts):
+        lookups = self.pending_lookups(concepts)
+        log.debug('Prefetching %d terms', len(lookups))
+        await asyncio.gather(*[self.lookup(*lookup) for lookup in lookups])
+
+    async def authorize_concept(self, concept):
+        vocab = self.get_vocabulary(concept)
+        if vocab is None:
+            return
+
+        self.update_concept(concept, await self.lookup(vocab, concept.term, concept.tag))
+
+
+class AsyncJob(Job):
+    """
+    Job runner for the asyncio engine. Records are fetched, modified and stored
+    with at most `concurrency` records in flight at a time. The steps themselves
+    run on the event loop thread, so the change counters need no locking.
+
+    Only non-interactive jobs are supported.
+    """
+
+    def __init__(self, *args, concurrency=20, **kwargs):
+        self.concurrency = concurrency
+        super().__init__(*args, **kwargs)
+        self.interactivity = INTERACTIVITY_NONE
+
+    def authorize(self):
+        pass  # The target concepts are authorized asynchronously when the job starts
+
+    async def authorize_concepts(self):
+        concepts = self.concepts_to_authorize()
+        if len(concepts) > 1:
+            await self.authorities.prefetch(concepts)
+        for concept in concepts:
+            await self.authorities.authorize_concept(concept)
+        self.check_authorized(concepts)
+
+    async def process_record(self, semaphore, idx, mms_id, total):
+        async with semaphore:
+            record = await self.ils.get_record(mms_id)
+            progress = {'current': idx + 1, 'total': total}
+            self.show_record(record.marc_record, progress)
+            changes = self.modify_record(record, progress)
+            if changes > 0 and self.verify and record.cached:
+                fresh = await self.ils.get_record(mms_id, fresh=True)
+                if self.was_changed(record, fresh):
+                    record = fresh
+                    changes = self.reconcile(fresh, progress)
+            if changes > 0:
+                stored = await self.ils.put_record(record, interactive=False, show_diff=self.show_diffs)
+                if stored or self.dry_run:
+                    self.count_changes(changes)
+
+    async def start(self):
+        await self.authorize_concepts()
+
+        valid_records = OrderedDict()  # SRU may return the same record more than once
+        try:
+            async for marc_record in self.sru.search(self.cql_query):
+                if self.select_record(marc_record):
+                    valid_records[marc_record.id] = None
+        except TooManyResults:
+            log.error(TOO_MANY_RESULTS_MESSAGE)
+            return []
+
+        if len(valid_records) == 0:
+            log.info('No matching catalog records found')
+            return []
+
+        log.info('%d catalog records found', len(valid_records))
+        if self.dry_run:
+            log.warning('DRY RUN: No catalog records will actually be changed!')
+
+        self.records_changed = 0
+        self.changes_made = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[
+            self.process_record(semaphore, idx, mms_id, len(valid_records))
+            for idx, mms_id in enumerate(valid_records)
+        ])
+
+        return valid_records
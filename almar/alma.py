@@ -1,13 +1,14 @@
 # coding=utf-8
 from __future__ import unicode_literals
 import logging
-from io import BytesIO
 from prompter import yesno
-from requests import Session, HTTPError
+from requests import RequestException
 from textwrap import dedent
 
-from .util import get_diff, format_diff
 from .bib import Bib
+from .cache import namespaced
+from .scheduler import RequestScheduler
+from .transport import Transport
 
 log = logging.getLogger(__name__)
 
@@ -25,43 +26,66 @@ class Alma(LibrarySystem):
 
     name = None
 
-    def __init__(self, api_region, api_key, cache, cache_time=300, name=None, dry_run=False):
+    def __init__(self, api_region, api_key, cache, cache_time=300, name=None, dry_run=False, transport=None,
+                 scheduler=None, preimages=None):
         self.api_region = api_region
         self.api_key = api_key
         self.name = name
         self.dry_run = dry_run
-        self.cache = cache
+        self.cache = namespaced(cache, 'bib', cache_time)
         self.cache_time = cache_time
-        self.session = Session()
-        self.session.headers.update({'Authorization': 'apikey %s' % api_key})
+        self._transport = transport
+        self._scheduler = scheduler
+        self.preimages = preimages  # PreimageStore for the records as they were before they were changed
+        self.headers = {'Authorization': 'apikey %s' % api_key}
         self.base_url = 'https://api-{region}.hosted.exlibrisgroup.com/almaws/v1'.format(region=self.api_region)
 
+    @property
+    def transport(self):
+        # Created on first use, since AsyncAlma sends its requests with aiohttp instead
+        if self._transport is None:
+            self._transport = Transport()
+        return self._transport
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = RequestScheduler(self.transport)
+        return self._scheduler
+
     def url(self, path, **kwargs):
         return self.base_url.rstrip('/') + '/' + path.lstrip('/').format(**kwargs)
 
-    def get_and_cache(self, record_id, cache_key):
-        response = self.session.get(self.url('/bibs/{mms_id}', mms_id=record_id))
-        response.raise_for_status()
-        self.cache.set(cache_key, response.text, expire=self.cache_time)
-        return response.text
+    def get_bib(self, record_id, headers=None):
+        return self.scheduler.get(self.url('/bibs/{mms_id}', mms_id=record_id),
+                                  headers=dict(self.headers, **(headers or {})))
 
-    def get_record(self, record_id):
+    def get_record(self, record_id, fresh=False):
         """
         Get a Bib record from Alma
 
         :type record_id: string
+        :param fresh: Check with Alma even if the record is cached. The request is
+            conditional if possible, so an unchanged record isn't downloaded again.
         """
-        cache_key = 'bib:{}'.format(record_id)
-        response = self.cache.get(cache_key) or self.get_and_cache(record_id, cache_key)
+        response, cached = self.cache.fetch_item(record_id, lambda headers: self.get_bib(record_id, headers),
+                                                 revalidate=fresh)
+        record = self.make_bib(record_id, response)
+        record.cached = cached
+        return record
+
+    @staticmethod
+    def make_bib(record_id, response):
         record = Bib(response)
         if record.id != record_id:
             raise RuntimeError('Response does not contain the requested MMS ID. %s != %s'
                                % (record.id, record_id))
         return record
 
-    def put_record(self, record, interactive=True, show_diff=False):
+    def prepare_put(self, record, interactive=True, show_diff=False):
         """
-        Store a Bib record to Alma
+        Check a Bib record before storing it to Alma, and log the diff.
+        Returns False if the record should not be stored.
 
         :param show_diff: bool
         :param interactive: bool
@@ -77,30 +101,41 @@ class Alma(LibrarySystem):
 
             if not interactive or yesno('Do you want to update the record and break CZ linkage?', default='no'):
                 log.warning(' -> Skipping this record. You should update it manually in Alma!')
-                return
+                return False
 
             log.warning(' -> Updating the record. The CZ connection will be lost!')
 
-        post_data = record.xml()
-        diff = get_diff(record.orig_xml, post_data)
-        additions = len([x for x in diff[2:] if x[0] == '+'])
-        deletions = len([x for x in diff[2:] if x[0] == '-'])
-        if show_diff:
-            log.info('%d line(s) removed, %d line(s) added:\n%s', deletions, additions, format_diff(diff))
-        else:
-            log.debug('%d line(s) removed, %d line(s) added:\n%s', deletions, additions, format_diff(diff))
-
-        cache_key = 'bib:{}'.format(record.id)
-
-        if not self.dry_run:
-            try:
-                response = self.session.put(self.url('/bibs/{mms_id}', mms_id=record.id),
-                                            data=BytesIO(post_data.encode('utf-8')),
-                                            headers={'Content-Type': 'application/xml'})
-                response.raise_for_status()
-                self.cache.delete(cache_key)
-                record.init(response.text)
-
-            except HTTPError:
-                msg = '*** Failed to save record %s --- Please try to edit the record manually in Alma ***'
-                log.error(msg, record.id)
+        # The diff is only rendered if the message is logged
+        diff = record.diff()
+        log.log(logging.INFO if show_diff else logging.DEBUG, '%d line(s) removed, %d line(s) added:\n%s',
+                diff.deletions, diff.additions, diff)
+
+        return True
+
+    def put_record(self, record, interactive=True, show_diff=False):
+        """
+        Store a Bib record to Alma. Returns True if the record was stored.
+
+        :param show_diff: bool
+        :param interactive: bool
+        :type record: Bib
+        """
+        if not self.prepare_put(record, interactive, show_diff) or self.dry_run:
+            return False
+
+        if self.preimages is not None:
+            record.preimage = self.preimages.put(record.orig_xml)
+
+        try:
+            response = self.scheduler.put(self.url('/bibs/{mms_id}', mms_id=record.id),
+                                          data=record.xml(),
+                                          headers=dict(self.headers, **{'Content-Type': 'application/xml'}))
+            response.raise_for_status()
+            self.cache.delete(record.id)
+            record.init(response.content)
+            return True
+
+        except RequestException:
+            msg = '*** Failed to save record %s --- Please try to edit the record manually in Alma ***'
+            log.error(msg, record.id)
+            return False
@@ -26,9 +26,20 @@ from six import binary_type
 from . import __version__
 from .authorities import Vocabulary, Authorities
 from .alma import Alma
+from .batch import BatchJob, read_mapping
+from .cache import ResponseCache, get_store_settings
 from .concept import Concept
+from .export import MarcXmlWriter
 from .job import Job
+from .journal import Journal
+from .marcxml import MarcXmlReader
+from .partition import PartitionedSruClient
+from .preimages import PreimageStore
+from .rollback import Rollback
+from .scheduler import RequestScheduler
+from .skos import LocalVocabulary
 from .sru import SruClient
+from .transport import Transport
 from .util import ANY_VALUE, INTERACTIVITY_NONE, INTERACTIVITY_STANDARD, INTERACTIVITY_INCREASED
 from .util import ColorStripFormatter, JobNameFilter
 
@@ -100,6 +111,35 @@ def parse_args(args, default_env=None):
     parser.add_argument('-i', '--interactive', dest='interactive', action='store_true',
                         help='Interactive mode: ask to confirm each change.')
 
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of records to fetch and save concurrently. Only used in '
+                        'non-interactive mode (-n). Default: 1')
+
+    parser.add_argument('--resume', dest='resume', metavar='JOB',
+                        help='Resume an interrupted job, given its name (or the start of it) from the log. '
+                        'The job is resumed with the same options and terms as it was started with.')
+
+    parser.add_argument('--file', dest='files', action='append', default=[], metavar='PATH',
+                        help='Read the records to check from a MARCXML file (can be gzipped), such as an Alma '
+                        'publishing export, instead of searching SRU. Can be repeated.')
+
+    parser.add_argument('--output', dest='output', metavar='PATH',
+                        help='Offline mode: write the modified records to a MARCXML file (gzipped if PATH ends '
+                        'with .gz) for import into Alma, instead of updating them with the API. Usually combined '
+                        'with --file.')
+
+    parser.add_argument('--partition', dest='partition', nargs='?', type=int, const=1, metavar='N',
+                        help='Split queries matching more than 10,000 records into smaller parts by '
+                        'publication year, and search N parts concurrently. Default: 1')
+
+    parser.add_argument('--match-processes', dest='match_processes', type=int, default=1, metavar='N',
+                        help='Number of processes to use for checking the search results (or the records from '
+                        '--file) against the terms. Useful for large result sets. Default: 1')
+
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='Before storing a record that was read from the cache, check that it has not been changed '
+                        'in Alma in the meantime. If it has, the changes are made to the new version instead.')
+
     parser.add_argument('--diffs', dest='show_diffs', action='store_true',
                         help='Show diffs (deprecated option, now enabled by default).')
 
@@ -148,11 +188,23 @@ def parse_args(args, default_env=None):
     parser_int.add_argument('new_terms', nargs='+', default='', help='Replacement terms')
     parser_int.set_defaults(action='interactive')
 
+    # Create parser for the "batch" command
+    parser_batch = subparsers.add_parser('batch', help='Run many replace/remove jobs in a single pass')
+    parser_batch.add_argument('file', help='CSV or YAML file mapping source terms to target terms')
+    parser_batch.set_defaults(action='batch')
+
     # Create parser for the "list" command
     parser_list = subparsers.add_parser('list', help='List documents')
     parser_list.add_argument('term', nargs=1, help='Term to search for')
     parser_list.set_defaults(action='list')
 
+    # Create parser for the "rollback" command
+    parser_rollback = subparsers.add_parser('rollback', help='Undo the changes made by a job')
+    parser_rollback.add_argument('job', help='Name of the job (or the start of it) from the log')
+    parser_rollback.add_argument('--force', dest='force', action='store_true',
+                                 help='Also restore records that have been changed after the job')
+    parser_rollback.set_defaults(action='rollback')
+
     # Parse
     args = parser.parse_args(args)
 
@@ -163,6 +215,12 @@ def parse_args(args, default_env=None):
     if 'new_terms' not in args:
         args.new_terms = []
 
+    if args.resume is not None:
+        return args  # the remaining arguments are read from the job journal
+
+    if getattr(args, 'action', None) == 'rollback':
+        return args
+
     if 'action' not in args:
         if len(args.remove) == 0 and len(args.add) == 0:
             parser.error('Please specify an action or one or more --rem or --add clauses.')
@@ -174,6 +232,19 @@ def parse_args(args, default_env=None):
     if args.interactive and args.non_interactive:
         parser.error('-n and -i are mutually exclusive')
 
+    if args.output is not None and args.action in ['list', 'interactive', 'batch']:
+        parser.error('--output cannot be used with the %s command' % args.action)
+
+    if args.action == 'batch' and args.cql_query is not None:
+        parser.error('--cql cannot be used with batch, since each job searches for its own terms')
+
+    if len(args.files) > 0:
+        # Records read from a file are not filtered by a query, so there must be a term to select them by
+        if args.cql_query is not None:
+            parser.error('--cql cannot be used with --file')
+        if args.action == 'add' or (args.action == 'custom' and len(args.remove) == 0):
+            parser.error('--file needs a term to select the records by, so it cannot be used with add or --add only')
+
     if args.env is not None:
         args.env = args.env.strip()
 
@@ -259,14 +330,27 @@ def get_concept(term, default_vocabulary, default_tag=None, default_term=None):
     return Concept(default_tag, sf)
 
 
-def job_args(config=None, args=None):
-
+def get_authorities(config, transport=None, cache=None):
     vocabularies = {}
     for vocab in config.get('vocabularies', []):
+        if vocab.get('file'):
+            vocabularies[ensure_unicode(vocab['marc_code'])] = LocalVocabulary.from_file(
+                ensure_unicode(vocab['marc_code']),
+                os.path.expanduser(vocab['file']),
+                index_path=os.path.expanduser(vocab['index']) if vocab.get('index') else None,
+                language=vocab.get('language'),
+            )
+            continue
         vocabularies[ensure_unicode(vocab['marc_code'])] = Vocabulary(
             ensure_unicode(vocab['marc_code']),
             ensure_unicode(vocab.get('id_service')),
+            transport=transport,
         )
+    return Authorities(vocabularies, cache=cache)
+
+
+def job_args(config=None, args=None, transport=None, authorities=None):
+
     default_vocabulary = ensure_unicode(config['default_vocabulary'])
 
     source_concepts = [
@@ -346,7 +430,7 @@ def job_args(config=None, args=None):
             for code in source_concepts[0].sf:
                 if not target_concept.has_subfield(code) and code != '0':
                     log.debug('Adding explicit "%s: None" to target concept %s', code, target_concept)
-                    target_concept.sf[code] = None  # meaning NO_VALUE
+                    target_concept.set_subfield(code, None)  # meaning NO_VALUE
 
     """ Caveat 4b:
 
@@ -373,7 +457,7 @@ def job_args(config=None, args=None):
             for code in target_concept.sf:
                 if not source_concepts[0].has_subfield(code) and code != '0':
                     log.debug('Adding explicit "%s: None" to source concept %s', code, source_concepts[0])
-                    source_concepts[0].sf[code] = None  # meaning NO_VALUE
+                    source_concepts[0].set_subfield(code, None)  # meaning NO_VALUE
 
     """ Caveat 5:
 
@@ -386,7 +470,7 @@ def job_args(config=None, args=None):
     """
     for source_concept in source_concepts:
         if '0' not in source_concept.sf:
-            source_concept.sf['0'] = ANY_VALUE
+            source_concept.set_subfield('0', ANY_VALUE)
 
     list_options['show_titles'] = args.show_titles
     list_options['show_subjects'] = args.show_subjects
@@ -398,7 +482,7 @@ def job_args(config=None, args=None):
         'list_options': list_options,
         'cql_query': args.cql_query,
         'grep': args.grep,
-        'authorities': Authorities(vocabularies)
+        'authorities': authorities or get_authorities(config, transport),
     }
 
 
@@ -427,7 +511,16 @@ def get_config():
     return config
 
 
-def run(config, cache, argv):
+def get_job_dir(config, username):
+    return config.get('job_dir') or os.path.join(tempfile.gettempdir(), 'almar-jobs-%s' % username)
+
+
+def log_resume_hint(journal, jobname):
+    if journal is not None and journal.pending():
+        logging.getLogger().info('The job can be resumed with: almar --resume %s', jobname[:10])
+
+
+def run(config, cache, argv, job_dir=None):
     global raven_client
 
     username = getpass.getuser()
@@ -449,15 +542,42 @@ def run(config, cache, argv):
     # Note: configure_logging will add a StreamHandler for stdout
     args = parse_args(argv, config.get('default_env'))
 
+    journal = None
+    if args.resume is not None and job_dir is not None:
+        journal = Journal.find(job_dir, args.resume)
+        if journal is not None:
+            jobname = journal.jobname
+    elif getattr(args, 'action', None) == 'rollback' and job_dir is not None:
+        journal = Journal.find(job_dir, args.job)
+        if journal is not None:
+            jobname = journal.jobname
+
     configure_logging(config.get('logging', logging_defaults), jobname, args.verbose)
     log = logging.getLogger()
     if sys.version_info < (3, 5):
         log.error('Sorry, Python < 3.5 is not supported.')
         sys.exit(1)
+
+    if args.resume is not None:
+        if journal is None:
+            log.error('Could not find a journal for the job "%s" in %s', args.resume, job_dir)
+            sys.exit(1)
+        args = parse_args(journal.argv, config.get('default_env'))
+    elif args.action == 'rollback':
+        if journal is None:
+            log.error('Could not find a journal for the job "%s" in %s', args.job, job_dir)
+            sys.exit(1)
+        args.env = parse_args(journal.argv, config.get('default_env')).env  # the environment the job ran in
+    elif job_dir is not None and args.action != 'list' and not args.dry_run and args.output is None:
+        journal = Journal.create(job_dir, jobname, argv)
     log.debug('Starting job %s as %s', jobname, username)
+    if journal is not None:
+        log.debug('Using job journal: %s', journal.path)
     log.debug('Using cache dir: %s', cache.directory)
 
-    jargs = job_args(config, args)
+    transport = Transport.from_config(config.get('http') or {})
+    authorities = get_authorities(config, transport, cache)
+    jargs = job_args(config, args, transport, authorities) if args.action != 'rollback' else None
 
     if config.get('sentry') is not None:
         raven_client = Client(config['sentry']['dsn'])
@@ -479,23 +599,54 @@ def run(config, cache, argv):
 
         env = get_env(config, args)
 
+        cache_time = os.environ.get('CACHE_TIME', 300)  # in seconds
+        sru_cache = ResponseCache(cache, 'sru', cache_time)
+        bib_cache = ResponseCache(cache, 'bib', cache_time)
+
         sru = SruClient(
             env['sru_url'],
-            cache,
+            sru_cache,
             name=args.env,
-            cache_time=os.environ.get('CACHE_TIME', 300)  # in seconds
+            workers=int(env.get('sru_workers', 4)),
+            transport=transport,
         )
 
+        if len(args.files) > 0:
+            sru = MarcXmlReader(args.files)
+        elif args.partition is not None:
+            sru = PartitionedSruClient(sru, workers=args.partition)
+
+        preimages = None
+        if journal is not None and args.action != 'rollback':
+            preimages = PreimageStore(journal.preimages_path)
+
         alma = Alma(
             env['api_region'],
             env['api_key'],
-            cache,
+            bib_cache,
             name=args.env,
             dry_run=args.dry_run,
-            cache_time=os.environ.get('CACHE_TIME', 300)  # in seconds
+            transport=transport,
+            scheduler=RequestScheduler(transport, rate=float(env.get('api_rate_limit', 25))),
+            preimages=preimages,
         )
 
-        job = Job(sru=sru, ils=alma, **jargs)
+        if args.action == 'rollback':
+            Rollback(journal, PreimageStore(journal.preimages_path), alma, workers=args.workers,
+                     force=args.force, dry_run=args.dry_run).start()
+            return
+
+        if args.action == 'batch':
+            # --grep applies to every job, while --cql was rejected by parse_args
+            global_argv = ['--grep', args.grep] if args.grep is not None else []
+            batch_jargs = [
+                job_args(config, parse_args(global_argv + argv, config.get('default_env')), transport, authorities)
+                for argv in read_mapping(args.file)
+            ]
+            authorities.prefetch([concept for jargs in batch_jargs for concept in jargs['target_concepts']])
+            job = BatchJob([Job(sru=sru, ils=alma, **jargs) for jargs in batch_jargs], sru=sru, ils=alma)
+        else:
+            job = Job(sru=sru, ils=alma, **jargs)
         job.dry_run = args.dry_run
         if args.non_interactive:
             job.interactivity = INTERACTIVITY_NONE
@@ -505,14 +656,28 @@ def run(config, cache, argv):
             job.interactivity = INTERACTIVITY_STANDARD
 
         job.verbose = args.verbose
+        job.workers = args.workers
+        job.match_processes = args.match_processes
         job.show_diffs = args.show_diffs
+        job.verify = args.verify
+        job.journal = journal
 
-        concepts = jargs['source_concepts'] + jargs['target_concepts']
-        jobdesc = '%s %s' % (jargs['action'], ' '.join(["'%s'" % text_type(x) for x in concepts]))
+        if args.action == 'batch':
+            jobdesc = 'batch %s (%d jobs)' % (args.file, len(job.jobs))
+        else:
+            concepts = jargs['source_concepts'] + jargs['target_concepts']
+            jobdesc = '%s %s' % (jargs['action'], ' '.join(["'%s'" % text_type(x) for x in concepts]))
 
         log.debug('Job arguments: %s', jobdesc)
 
-        job.start()
+        if args.output is not None:
+            with MarcXmlWriter(args.output) as writer:
+                job.export_records(writer)
+        else:
+            job.start()
+
+        for response_cache in [sru_cache, bib_cache, authorities.cache]:
+            response_cache.log_stats()
 
         if job.changes_made > 0:
             log.info('Job %s completed. Made %d changes to %d records', jobname, job.changes_made, job.records_changed)
@@ -521,17 +686,25 @@ def run(config, cache, argv):
             summary.info('%s - %s - %s - Made %d changes to %d records',
                          jobname, username, jobdesc, job.changes_made, job.records_changed)
 
+    except KeyboardInterrupt:
+        if args.action != 'rollback':
+            log_resume_hint(journal, jobname)
+        raise
+
     except Exception:  # # pylint: disable=broad-except
         if raven_client is not None:
             raven_client.captureException()
         log.exception('Uncaught exception:')
+        if args.action != 'rollback':
+            log_resume_hint(journal, jobname)
 
 
 def main():
     username = getpass.getuser()
     cache_dir = os.path.join(tempfile.gettempdir(), 'almar-cache-%s' % username)
-    with Cache(cache_dir) as cache:
-        run(get_config(), cache, sys.argv[1:])
+    config = get_config()
+    with Cache(cache_dir, **get_store_settings(config.get('cache') or {})) as cache:
+        run(config, cache, sys.argv[1:], job_dir=get_job_dir(config, username))
 
 
 if __name__ == '__main__':
@@ -1,30 +1,110 @@
 # coding=utf-8
 from __future__ import unicode_literals
-import requests
 import logging
 import json
 from colorama import Fore, Style
-from .util import ANY_VALUE, pick, pick_one
+from .cache import namespaced
+from .transport import Transport
+from .util import ANY_VALUE, pick, pick_one, imap_ordered
 
 log = logging.getLogger(__name__)
 
 
 class Authorities(object):
+    """
+    Authorizes concepts by looking up their terms with the ID lookup service of
+    their vocabulary.
 
-    def __init__(self, vocabularies):
+    Lookups are memoized for the lifetime of the object, and, if a cache is given,
+    stored in the cache: terms that were found for `cache_time` seconds, and terms
+    that were not found for `negative_cache_time` seconds. Failed lookups are not cached.
+
+    :param vocabularies: Dict of MARC code -> Vocabulary
+    :param cache: ResponseCache, or a diskcache.Cache or similar
+    """
+
+    def __init__(self, vocabularies, cache=None, cache_time=86400, negative_cache_time=3600):
         self.vocabularies = vocabularies
+        self.cache = namespaced(cache, 'authority', cache_time) if cache is not None else None
+        self.cache_time = cache_time
+        self.negative_cache_time = negative_cache_time
+        self.responses = {}  # cache key -> response
 
-    def authorize_concept(self, concept):
+    def get_vocabulary(self, concept):
         if '2' not in concept.sf:
             raise ValueError('No vocabulary code (2) given!')
         if concept.sf['2'] in self.vocabularies:
-            vocab = self.vocabularies[concept.sf['2']]
-        else:
-            log.info(Fore.RED + '✘' + Style.RESET_ALL + ' Could not authorize: %s', concept)
+            return self.vocabularies[concept.sf['2']]
+        log.info(Fore.RED + '✘' + Style.RESET_ALL + ' Could not authorize: %s', concept)
+
+    @staticmethod
+    def get_cache_key(vocab, term, tag):
+        return '{}:{}:{}'.format(vocab.marc_code, tag, term)
+
+    def get_response(self, vocab, cache_key):
+        """
+        Return the memoized or cached response for a lookup, or None.
+        """
+        if cache_key in self.responses:
+            return self.responses[cache_key]
+
+        if self.cache is None or not vocab.remote:  # local lookups are faster than the cache
+            return None
+        response = self.cache.get(cache_key)
+        if response is not None:
+            self.responses[cache_key] = response
+        return response
+
+    def set_response(self, vocab, cache_key, response):
+        if self.cache is not None and vocab.remote and response:  # an empty response means that the lookup failed
+            expire = self.cache_time if response.get('id') is not None else self.negative_cache_time
+            self.cache.set(cache_key, response, expire=expire)
+        self.responses[cache_key] = response
+
+    def lookup(self, vocab, term, tag):
+        """
+        Look up a term, using the cache if possible.
+        """
+        cache_key = self.get_cache_key(vocab, term, tag)
+        response = self.get_response(vocab, cache_key)
+        if response is None:
+            response = vocab.authorize_term(term, tag)
+            self.set_response(vocab, cache_key, response)
+        return response
+
+    def pending_lookups(self, concepts):
+        """
+        Return the (vocabulary, term, tag) lookups needed to authorize the concepts,
+        without duplicates and lookups that have already been made.
+        """
+        lookups = {}
+        for concept in concepts:
+            vocab = self.vocabularies.get(concept.sf.get('2'))
+            if vocab is not None and vocab.remote:
+                key = self.get_cache_key(vocab, concept.term, concept.tag)
+                lookups.setdefault(key, (vocab, concept.term, concept.tag))
+
+        return [lookup for key, lookup in lookups.items() if key not in self.responses]
+
+    def prefetch(self, concepts, workers=8):
+        """
+        Look up the terms of many concepts concurrently, so that authorizing them afterwards
+        won't need any requests.
+        """
+        lookups = self.pending_lookups(concepts)
+        log.debug('Prefetching %d terms', len(lookups))
+        for _ in imap_ordered(lambda lookup: self.lookup(*lookup), lookups, workers):
+            pass
+
+    def authorize_concept(self, concept):
+        vocab = self.get_vocabulary(concept)
+        if vocab is None:
             return
 
-        response = vocab.authorize_term(concept.term, concept.tag)
+        self.update_concept(concept, self.lookup(vocab, concept.term, concept.tag))
 
+    def update_concept(self, concept, response):
+        # Update the concept from the ID lookup service response
         if response.get('id') is not None:
             identifier = response.get('id')
             if concept.sf.get('0'):
@@ -35,7 +115,7 @@ class Authorities(object):
                         'The $$0 value does not match the authority record id. Please select which to use',
                         [concept.sf['0'], identifier]
                     )
-            concept.sf['0'] = identifier
+            concept.set_subfield('0', identifier)
             log.info(Fore.GREEN + '✔' + Style.RESET_ALL + ' Authorized: %s', concept)
         else:
             log.info(Fore.RED + '✘' + Style.RESET_ALL + ' Could not authorize: %s', concept)
@@ -45,30 +125,45 @@ class Vocabulary(object):
 
     marc_code = ''
     skosmos_code = ''
+    remote = True  # whether lookups need requests
 
-    def __init__(self, marc_code, id_service_url=None):
+    def __init__(self, marc_code, id_service_url=None, transport=None):
         self.marc_code = marc_code
         self.id_service_url = id_service_url
-
-    def authorize_term(self, term, tag):
-        # Lookup term with some id service to get the identifier to use in $0
-
-        if term == '':
-            return {}
-
-        url = self.id_service_url.format(vocabulary=self.marc_code, term=term, tag=tag)
-        response = requests.get(url)
-        log.debug('Authority service response: %s', response.text)
-        if response.status_code != 200 or response.text == '':
+        self._transport = transport
+
+    @property
+    def transport(self):
+        # Created on first use, since local and async vocabularies never need one
+        if self._transport is None:
+            self._transport = Transport()
+        return self._transport
+
+    def get_url(self, term, tag):
+        return self.id_service_url.format(vocabulary=self.marc_code, term=term, tag=tag)
+
+    @staticmethod
+    def parse_response(status_code, text):
+        log.debug('Authority service response: %s', text)
+        if status_code != 200 or text == '':
             return {}
 
         try:
-            response = json.loads(response.text)
+            response = json.loads(text)
         except ValueError:
-            log.error('ID lookup service returned: %s', response.text)
+            log.error('ID lookup service returned: %s', text)
             return {}
 
         if 'error' in response and response.get('uri') != 'info:srw/diagnostic/1/61':
             log.warning('ID lookup service returned: %s', response['error'])
 
         return response
+
+    def authorize_term(self, term, tag):
+        # Lookup term with some id service to get the identifier to use in $0
+
+        if term == '':
+            return {}
+
+        response = self.transport.get(self.get_url(term, tag))
+        return self.parse_response(response.status_code, response.text)
@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import csv
+import io
+import logging
+from collections import OrderedDict
+
+import yaml
+from six import string_types
+
+from .job import Job
+from .marcxml import MarcXmlReader
+from .matching import BatchSelector
+
+log = logging.getLogger(__name__)
+
+
+def mapping_args(source, targets):
+    # Command line arguments for a single replace or remove job
+    targets = [target for target in targets if target]
+    if len(targets) == 0:
+        return ['remove', source]
+    return ['replace', source] + targets
+
+
+def read_mapping(filename):
+    """
+    Read a mapping file and return a list of command line arguments, one for each job.
+
+    In CSV files, each row has a source term followed by one or more target terms.
+    A row with no target terms removes the source term. In YAML files, use either
+    a dict of source term -> target term(s), or a list of dicts with `source` and
+    `target` or `targets` keys. Terms use the same syntax as on the command line.
+    """
+    with io.open(filename, encoding='utf-8') as fp:
+        if filename.endswith('.yml') or filename.endswith('.yaml'):
+            mapping = yaml.load(fp, Loader=yaml.SafeLoader) or []
+            if isinstance(mapping, dict):
+                mapping = [{'source': source, 'targets': targets} for source, targets in mapping.items()]
+            rows = []
+            for item in mapping:
+                targets = item.get('targets', item.get('target')) or []
+                if isinstance(targets, string_types):
+                    targets = [targets]
+                rows.append([item['source']] + targets)
+        else:
+            rows = [
+                [value.strip() for value in row] for row in csv.reader(fp)
+                if len(row) > 0 and row[0].strip() and not row[0].startswith('#')
+            ]
+
+    return [mapping_args(row[0], row[1:]) for row in rows]
+
+
+class BatchJob(Job):
+    """
+    Runs many jobs in a single pass over the records: the records found by the
+    searches for all the jobs are merged, and each record is fetched, modified by
+    the steps from all the jobs that apply to it, and stored, only once.
+
+    Which jobs apply to a record is decided from the record fetched from Alma,
+    before any of the steps are run, so a record is not affected by chained
+    mappings (A -> B, B -> C) in the same batch.
+
+    When reading records from files (`--file`), there's no search to narrow down
+    the records for each job, so the files are read only once, and each record
+    is checked against all the jobs.
+
+    :param jobs: List of Job
+    """
+
+    def __init__(self, jobs, sru=None, ils=None):
+        # We don't have any terms of our own, so instead of the full Job setup,
+        # we just take the steps from the jobs.
+        self.init_runtime(sru, ils)
+        self.jobs = jobs
+
+        self.action = 'batch'
+        self.source_concepts = []
+        self.target_concepts = []
+        self.cql_query = None
+        self.grep = None
+        self.steps = [step for job in jobs for step in job.steps]
+        self.selector = BatchSelector([job.selector for job in jobs])
+
+    def find_records(self):
+        if isinstance(self.sru, MarcXmlReader):
+            return super(BatchJob, self).find_records()
+
+        valid_records = OrderedDict()
+        for n, job in enumerate(self.jobs):
+            log.info('Job %d/%d: %s', n + 1, len(self.jobs), job.cql_query)
+            job.show_progress = self.show_progress
+            job.match_processes = self.match_processes
+            records = job.find_records()
+            if records is None:
+                log.error('Skipping job %d, since the query matches too many records', n + 1)
+                continue
+            for mms_id in records:
+                valid_records[mms_id] = None
+
+        return valid_records
+
+    def match_record(self, marc_record):
+        return any(job.match_record(marc_record) for job in self.jobs)
+
+    def record_steps(self, marc_record):
+        return [step for job in self.jobs if job.match_record(marc_record) for step in job.steps]
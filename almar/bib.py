@@ -3,7 +3,9 @@
 from __future__ import unicode_literals
 
 from .marc import Record
-from .util import etree, parse_xml
+from .util import etree, parse_xml, line_marc, MarcDiff
+
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
 
 
 class Bib(object):
@@ -11,6 +13,9 @@ class Bib(object):
 
     def __init__(self, xml):
         self.orig_xml = xml
+        self.preimage = None  # key of orig_xml in a PreimageStore, once stored
+        self.cached = False  # whether the record came from the cache
+        self.orig_hash = None  # content hash of the record before it was modified
         self.init(xml)
 
     def init(self, xml):
@@ -19,11 +24,20 @@ class Bib(object):
         self.marc_record = Record(self.doc.find('record'))
         self.cz_link = self.doc.findtext('linked_record_id[@type="CZ"]') or None
 
+    def diff(self):
+        """
+        Diff the fields of the record against the fields it had when it was loaded,
+        using the changes logged by the record.
+
+        :rtype: MarcDiff
+        """
+        return MarcDiff.from_changes(line_marc(self.marc_record.el), self.marc_record.changes)
+
     def xml(self):
-        return (
-            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n%s' %
-            etree.tounicode(self.doc)
-        )
+        """
+        Serialize the record for the Bibs API, as UTF-8 encoded bytes.
+        """
+        return XML_DECLARATION + etree.tostring(self.doc, encoding='UTF-8')
 
     def dump(self, filename):
         # Dump record to file
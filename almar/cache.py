@@ -0,0 +1,235 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+import zlib
+from hashlib import sha1
+
+from six import binary_type, text_type
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+# Codec used for new entries. Each entry records the codec it was stored with,
+# so entries stay readable if zstandard is installed or removed later.
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'zlib'
+DECODE_ERRORS = (ValueError, zlib.error) if zstandard is None else (ValueError, zlib.error, zstandard.ZstdError)
+
+# Eviction policies supported by diskcache
+EVICTION_POLICIES = {
+    'lrs': 'least-recently-stored',
+    'lru': 'least-recently-used',
+    'lfu': 'least-frequently-used',
+}
+
+
+def get_store_settings(config):
+    """
+    Settings for the diskcache.Cache store from the `cache` section of the configuration file.
+    """
+    settings = {}
+    if config.get('size_limit') is not None:
+        settings['size_limit'] = int(float(config['size_limit']) * 1024 * 1024)  # in MB
+    if config.get('eviction_policy') is not None:
+        policy = config['eviction_policy']
+        settings['eviction_policy'] = EVICTION_POLICIES.get(policy, policy)
+    return settings
+
+
+class CacheEntry(object):
+    """
+    A cached value, with the validators from the response it came from.
+    """
+
+    __slots__ = ('value', 'stored_at', 'expire', 'etag', 'last_modified')
+
+    def __init__(self, value, stored_at, expire, etag=None, last_modified=None):
+        self.value = value
+        self.stored_at = stored_at
+        self.expire = expire
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def fresh(self):
+        return self.expire is None or time.time() < self.stored_at + self.expire
+
+    def validators(self):
+        # Headers for a conditional request
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    """
+    A namespace (like 'sru', 'bib' or 'authority') in a shared cache store,
+    like a diskcache.Cache. Size limits and eviction are handled by the store.
+
+    Text and bytes are stored compressed with zstd if zstandard is installed,
+    otherwise with zlib. Bytes are returned as bytes, so XML responses can be
+    handed to lxml without decoding them first. Entries for responses with an
+    ETag or a Last-Modified header are kept for `max_stale` seconds after they
+    expire, so they can be revalidated with a conditional request instead of
+    being downloaded again.
+
+    :param store: diskcache.Cache or similar
+    :param namespace: Prefix for the keys
+    :param expire: Default number of seconds before entries must be revalidated
+    :param max_stale: Number of seconds to keep expired entries that can be revalidated
+    :param codec: 'zstd' or 'zlib'
+    """
+
+    max_key_length = 200
+
+    def __init__(self, store, namespace, expire=300, max_stale=86400, codec=DEFAULT_CODEC):
+        self.store = store
+        self.namespace = namespace
+        self.codec = codec
+        self.expire = int(expire)
+        self.max_stale = max_stale
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, key):
+        # Long keys, like SRU queries, are hashed
+        key = text_type(key)
+        if len(key) > self.max_key_length:
+            key = sha1(key.encode('utf-8')).hexdigest()
+        return '{}:{}'.format(self.namespace, key)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def compress(codec, data):
+        if codec == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return zlib.compress(data)
+
+    @staticmethod
+    def decompress(codec, data):
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstandard is not installed')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def encode(self, value):
+        # Returns (codec, data). Text is stored as UTF-8, marked with a +utf-8 suffix on the codec.
+        if isinstance(value, text_type):
+            return self.codec + '+utf-8', self.compress(self.codec, value.encode('utf-8'))
+        if isinstance(value, binary_type):
+            return self.codec, self.compress(self.codec, value)
+        return None, value
+
+    def decode(self, codec, data):
+        if codec is None:
+            return data
+        codec, _, encoding = codec.partition('+')
+        data = self.decompress(codec, data)
+        return data.decode(encoding) if encoding else data
+
+    def lookup(self, key):
+        """
+        Return the CacheEntry for a key, also if it has expired, or None.
+        """
+        data = self.store.get(self.make_key(key))
+        if not isinstance(data, tuple):
+            return None
+        stored_at, expire, etag, last_modified, codec, value = data
+        try:
+            value = self.decode(codec, value)
+        except DECODE_ERRORS as err:
+            log.debug('Could not decode cache entry %s: %s', key, err)
+            return None
+        return CacheEntry(value, stored_at, expire, etag, last_modified)
+
+    def get(self, key):
+        """
+        Return the cached value for a key, or None if it's missing or has expired.
+        """
+        entry = self.lookup(key)
+        if entry is None or not entry.fresh:
+            self.count('misses')
+            return None
+        self.count('hits')
+        return entry.value
+
+    def set(self, key, value, expire=None, etag=None, last_modified=None):
+        expire = self.expire if expire is None else expire
+        keep = expire
+        if etag is not None or last_modified is not None:
+            keep += self.max_stale
+        codec, data = self.encode(value)
+        self.store.set(self.make_key(key), (time.time(), expire, etag, last_modified, codec, data), expire=keep)
+
+    def set_response(self, key, content, headers):
+        self.set(key, content, etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+
+    def delete(self, key):
+        self.store.delete(self.make_key(key))
+
+    def fetch(self, key, request):
+        """
+        Return the cached response body (bytes) for a key, or get it with `request`,
+        a function that takes a dict of extra headers and returns a requests Response.
+        Expired entries are revalidated if possible.
+        """
+        return self.fetch_item(key, request)[0]
+
+    def fetch_item(self, key, request, revalidate=False):
+        """
+        Like fetch, but returns a (response body, cached) tuple, where `cached` is
+        True if the response came from the cache without checking with the server.
+        With `revalidate`, the server is checked even if the entry is fresh.
+        """
+        entry = self.lookup(key)
+        if entry is not None and entry.fresh and not revalidate:
+            self.count('hits')
+            return entry.value, True
+
+        response = request(entry.validators() if entry is not None else {})
+        if response.status_code == 304 and entry is not None:
+            self.count('revalidated')
+            self.set(key, entry.value, etag=entry.etag, last_modified=entry.last_modified)
+            return entry.value, False
+
+        response.raise_for_status()
+        self.count('misses')
+        self.set_response(key, response.content, response.headers)
+        return response.content, False
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.revalidated
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'hit_rate': float(self.hits + self.revalidated) / lookups if lookups else 0.0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        if stats['hits'] + stats['misses'] + stats['revalidated'] > 0:
+            log.debug('Cache %s: %d hits, %d misses, %d revalidated (hit rate %.0f %%)', self.namespace,
+                      stats['hits'], stats['misses'], stats['revalidated'], stats['hit_rate'] * 100)
+
+
+def namespaced(cache, namespace, expire=300):
+    # Wrap a cache store in a ResponseCache, unless it already is one
+    if isinstance(cache, ResponseCache):
+        return cache
+    return ResponseCache(cache, namespace, expire)
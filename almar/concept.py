@@ -4,12 +4,63 @@ import logging
 from collections import OrderedDict
 from copy import deepcopy
 from six import python_2_unicode_compatible
-from .util import etree, ANY_VALUE
+from .util import etree, normalize_term, ANY_VALUE
 log = logging.getLogger(__name__)
 
 
+class ConceptMatcher(object):
+    """
+    Field matcher compiled from a Concept. The expected subfield values are
+    normalized once, up front, and each field is matched in a single pass over
+    its subfields, working directly on the lxml nodes.
+    """
+
+    __slots__ = ('tag', 'ind1', 'ind2', 'expected', 'allowed_codes')
+
+    def __init__(self, concept):
+        self.tag = concept.tag
+        self.ind1 = None if concept.ind1 == '?' else concept.ind1
+        self.ind2 = None if concept.ind2 == '?' else concept.ind2
+        self.expected = [
+            (code, normalize_term(value))
+            for code, value in concept.sf.items() if value != ANY_VALUE
+        ]
+        self.allowed_codes = set(concept.sf.keys()) | {'0', '9'}
+
+    def match(self, node, ignore_extra_subfields=False):
+        """
+        Return True if the datafield node matches the concept
+        """
+        if not node.get('tag').startswith(self.tag):
+            return False
+
+        if self.ind1 is not None and node.get('ind1') != self.ind1:
+            return False
+
+        if self.ind2 is not None and node.get('ind2') != self.ind2:
+            return False
+
+        values = {}  # code -> text of the first subfield with that code
+        for subfield in node.iterchildren('subfield'):
+            code = subfield.get('code')
+            if code not in values:
+                values[code] = subfield.text
+            if not ignore_extra_subfields and code not in self.allowed_codes:
+                return False
+
+        for code, expected in self.expected:
+            value = values.get(code)
+            if value != expected and value != ANY_VALUE and normalize_term(value) != expected:
+                return False
+
+        return True
+
+
 @python_2_unicode_compatible
 class Concept(object):
+
+    __slots__ = ('tag', '_sf', 'ind1', 'ind2', '_matcher')
+
     def __init__(self, tag, sf, ind1=None, ind2=None):
         if tag is None:
             raise ValueError('No tag given')
@@ -28,6 +79,34 @@ class Concept(object):
     def __deepcopy__(self, memodict):
         return Concept(tag=self.tag, sf=self.sf, ind1=self.ind1, ind2=self.ind2)
 
+    @property
+    def sf(self):
+        return self._sf
+
+    @sf.setter
+    def sf(self, sf):
+        self._sf = sf
+        self._matcher = None
+
+    def set_subfield(self, code, value):
+        # Modify the subfields through these methods rather than in place,
+        # so the compiled matcher is thrown away.
+        self._sf[code] = value
+        self._matcher = None
+
+    def remove_subfield(self, code):
+        del self._sf[code]
+        self._matcher = None
+
+    def matcher(self):
+        """
+        Return a ConceptMatcher for the concept. The matcher is compiled on
+        first use, and thrown away whenever the subfields are modified.
+        """
+        if self._matcher is None:
+            self._matcher = ConceptMatcher(self)
+        return self._matcher
+
     def has_subfield(self, code):
         if code in self.sf:
             return True
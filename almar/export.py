@@ -0,0 +1,75 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import gzip
+import io
+import json
+import logging
+from contextlib import ExitStack
+from copy import deepcopy
+
+from .sru import MARC_NS
+from .util import etree, add_namespace
+
+log = logging.getLogger(__name__)
+
+
+class MarcXmlWriter(object):
+    """
+    Writes modified records to a MARCXML collection file that can be loaded
+    with an Alma import profile, together with a manifest: a JSON lines file
+    with the MMS ID, the number of changes and the diff for each record.
+
+    Records are written as they come, so memory use doesn't depend on the
+    number of records. If the path ends with .gz, the file is gzipped.
+
+    Usage::
+
+        with MarcXmlWriter('changed.xml.gz') as writer:
+            writer.write(record, changes, diff)
+
+    :param path: Path to the MARCXML file
+    :param manifest_path: Path to the manifest. Default: the path of the MARCXML
+                          file, with .manifest.jsonl instead of .xml[.gz]
+    """
+
+    def __init__(self, path, manifest_path=None):
+        self.path = path
+        self.manifest_path = manifest_path or self.get_manifest_path(path)
+        self.count = 0
+        self.stack = None
+        self.xf = None
+        self.manifest = None
+
+    @staticmethod
+    def get_manifest_path(path):
+        for ext in ['.gz', '.xml']:
+            if path.endswith(ext):
+                path = path[:-len(ext)]
+        return path + '.manifest.jsonl'
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        if self.path.endswith('.gz'):
+            fp = self.stack.enter_context(gzip.open(self.path, 'wb'))
+        else:
+            fp = self.stack.enter_context(io.open(self.path, 'wb'))
+        self.xf = self.stack.enter_context(etree.xmlfile(fp, encoding='utf-8'))
+        self.xf.write_declaration()
+        self.stack.enter_context(self.xf.element('{%s}collection' % MARC_NS, nsmap={None: MARC_NS}))
+        self.manifest = self.stack.enter_context(io.open(self.manifest_path, 'w', encoding='utf-8'))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stack.__exit__(*exc_info)
+        log.info('Wrote %d records to %s', self.count, self.path)
+
+    def write(self, record, changes, diff):
+        """
+        :type record: Record
+        :param changes: Number of changes made to the record
+        :param diff: List of lines from MarcDiff.lines()
+        """
+        self.xf.write(add_namespace(deepcopy(record.el), MARC_NS))
+        self.manifest.write(json.dumps({'id': record.id, 'changes': changes, 'diff': diff}, ensure_ascii=False) + '\n')
+        self.count += 1
@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 
 import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 import re
@@ -10,37 +12,35 @@ from colorama import Fore, Back, Style
 from prompter import yesno
 from tqdm import tqdm
 
+from .journal import FETCHED, MODIFIED, UNCHANGED, PUT, FAILED
+from .matching import RecordSelector, select_records
 from .sru import TooManyResults
 from .task import AddTask, ReplaceTask, InteractiveReplaceTask, ListTask, DeleteTask, utf8print
-from .util import INTERACTIVITY_NONE, INTERACTIVITY_STANDARD, INTERACTIVITY_INCREASED
+from .util import INTERACTIVITY_NONE, INTERACTIVITY_STANDARD, INTERACTIVITY_INCREASED, imap_ordered
+from .util import MarcDiff, line_marc
 
 log = logging.getLogger(__name__)
 formatter = logging.Formatter('[%(asctime)s %(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%I:%S')
 
+TOO_MANY_RESULTS_MESSAGE = (
+    'More than 10,000 results would have to be checked, but the Alma SRU service does '
+    'not allow us to retrieve more than 10,000 results. Annoying? Go vote for this:\n'
+    'http://ideas.exlibrisgroup.com/forums/308173-alma/suggestions/'
+    '18737083-sru-srw-increase-the-10-000-record-retrieval-limi\n'
+    'Meanwhile, use --partition to split the query into smaller parts.'
+)
+
 
 class Job(object):
     def __init__(self, action, source_concepts=[], target_concepts=[], sru=None, ils=None,
                  list_options=None, authorities=None, cql_query=None, grep=None):
 
-        self.dry_run = False
-        self.interactivity = INTERACTIVITY_STANDARD
-        self.show_progress = True
-        self.show_diffs = False
-        self.list_options = list_options or {}
-
-        self.records_changed = 0
-        self.changes_made = 0
-
-        self.sru = sru
-        self.ils = ils
-        self.authorities = authorities
+        self.init_runtime(sru, ils, authorities, list_options)
 
         self.action = action
         self.source_concepts = source_concepts
         self.target_concepts = target_concepts
 
-        self.job_name = datetime.now().isoformat()
-
         if (
             len(self.source_concepts) > 0 and
             self.source_concepts[0].tag == '648' and
@@ -75,6 +75,31 @@ class Job(object):
 
         self.steps = []
         self.generate_steps()
+        self.selector = RecordSelector(self.action, self.steps, self.grep)
+
+    def init_runtime(self, sru, ils, authorities=None, list_options=None):
+        """
+        Set the options and state used when processing the records. Shared with
+        subclasses that set up their steps differently, like BatchJob.
+        """
+        self.dry_run = False
+        self.interactivity = INTERACTIVITY_STANDARD
+        self.show_progress = True
+        self.show_diffs = False
+        self.verify = False  # check cached records against Alma before storing them
+        self.workers = 1  # number of records to fetch/store concurrently in non-interactive mode
+        self.match_processes = 1  # number of processes to use for selecting records from the search results
+        self.list_options = list_options or {}
+        self.journal = None  # Journal to log the progress to, if any
+
+        self.records_changed = 0
+        self.changes_made = 0
+
+        self.sru = sru
+        self.ils = ils
+        self.authorities = authorities
+
+        self.job_name = datetime.now().isoformat()
 
     @staticmethod
     def generate_replace_tasks(src, dst):
@@ -135,48 +160,157 @@ class Job(object):
             for target_concept in self.target_concepts[1:]:
                 self.steps.append(AddTask(target_concept))
 
-    def update_record(self, record, progress):
+    def record_steps(self, marc_record):
         """
-        Update the record and save it back to Alma if any changes were made.
+        Return the steps to run on a record.
+        """
+        return self.steps
+
+    def modify_record(self, record, progress):
+        """
+        Run all the steps on the record, without saving it.
         Returns the number of changes made.
         """
+        if record.orig_hash is None:
+            record.orig_hash = record.marc_record.content_hash()
+
         changes = 0
-        for step in self.steps:
+        for step in self.record_steps(record.marc_record):
             changes += step.run(record.marc_record, progress)
 
+        # The steps may cancel each other out, like a replace followed by removing the
+        # resulting duplicate, so compare the content to avoid storing unchanged records.
+        if changes > 0 and record.marc_record.content_hash() == record.orig_hash:
+            log.info('Record %s ended up unchanged', record.id)
+            changes = 0
+
+        if changes > 0 and self.interactivity == INTERACTIVITY_INCREASED:
+            if not yesno('Update this record?', default='yes'):
+                record.marc_record.undo()
+                changes = 0
+
         if changes == 0:
-            return 0
+            self.log_status(record.id, UNCHANGED)
+        elif self.journal is not None:
+            self.log_status(record.id, MODIFIED, changes=changes, diff=record.diff().lines())
+
+        return changes
 
-        if self.interactivity == INTERACTIVITY_INCREASED and not yesno('Update this record?', default='yes'):
-            return 0
+    def fetch_record(self, mms_id):
+        record = self.ils.get_record(mms_id)
+        self.log_status(mms_id, FETCHED)
+        return record
 
-        self.ils.put_record(record, interactive=self.interactivity != INTERACTIVITY_NONE, show_diff=self.show_diffs)
+    @staticmethod
+    def was_changed(record, fresh):
+        """
+        Return True if the fresh copy of a record from Alma differs from the
+        version the steps were run on.
+        """
+        fresh.orig_hash = fresh.marc_record.content_hash()
+        return fresh.orig_hash != record.orig_hash
+
+    def reconcile(self, fresh, progress=None):
+        """
+        Run the steps again on the new version of a record that was changed in Alma
+        since it was cached. Returns the number of changes made. Like modify_record,
+        this must be called from the main thread.
+        """
+        log.info('Record %s has been changed in Alma since it was cached, applying the changes to the new version',
+                 fresh.id)
+        return self.modify_record(fresh, progress)
+
+    def store_record(self, record):
+        """
+        Store a modified record, checking it against Alma first if it came from the cache
+        and `verify` is set. Returns a (stored, fresh) tuple, where `fresh` is the new version
+        of the record if it was changed in Alma, in which case nothing is stored, and the
+        steps must be run again with reconcile. Safe to call from the worker threads.
+        """
+        if self.verify and record.cached:
+            fresh = self.ils.get_record(record.id, fresh=True)
+            if self.was_changed(record, fresh):
+                return False, fresh
+
+        saved = self.ils.put_record(record, interactive=self.interactivity != INTERACTIVITY_NONE,
+                                    show_diff=self.show_diffs)
+        if not self.dry_run:
+            if saved and record.preimage is not None:
+                # What we need to roll back the change, and to check that nobody changed the record since
+                self.log_status(record.id, PUT, preimage=record.preimage, hash=record.marc_record.content_hash())
+            else:
+                self.log_status(record.id, PUT if saved else FAILED)
+        return saved or self.dry_run, None
+
+    def save_record(self, record, changes, progress=None):
+        """
+        Store a modified record. Returns the number of changes stored (or that would
+        have been, in a dry run), or 0 if the record wasn't stored.
+        """
+        stored, fresh = self.store_record(record)
+        if fresh is not None:
+            changes = self.reconcile(fresh, progress)
+            stored = changes > 0 and self.store_record(fresh)[0]
+        return changes if stored else 0
+
+    def log_status(self, mms_id, status, **kwargs):
+        if self.journal is not None:
+            self.journal.set_status(mms_id, status, **kwargs)
+
+    def update_record(self, record, progress):
+        """
+        Update the record and save it back to Alma if any changes were made.
+        Returns the number of changes stored.
+        """
+        changes = self.modify_record(record, progress)
+        if changes > 0:
+            changes = self.save_record(record, changes, progress)
 
         return changes
 
-    def authorize(self):
+    def concepts_to_authorize(self):
         if self.action in ['remove']:
-            return
+            return []
 
         # self.source_concept.authorize()
-        if len(self.target_concepts) == 0:
-            return
-        self.authorities.authorize_concept(self.target_concepts[0])
+        return self.target_concepts
+
+    def authorize(self):
+        concepts = self.concepts_to_authorize()
+        if len(concepts) > 1:
+            self.authorities.prefetch(concepts)
+        for concept in concepts:
+            self.authorities.authorize_concept(concept)
+        self.check_authorized(concepts)
 
-        if '0' not in self.target_concepts[0].sf:
+    @staticmethod
+    def check_authorized(concepts):
+        if len(concepts) > 0 and '0' not in concepts[0].sf:
             log.warning('The (first) target term could not be authorized.')
 
-        for target_concept in self.target_concepts[1:]:
-            self.authorities.authorize_concept(target_concept)
+    def match_record(self, marc_record):
+        return self.selector.match_record(marc_record)
 
-    def start(self):
+    def would_change(self, marc_record):
+        return self.selector.would_change(marc_record)
 
-        if self.ils.name is not None:
-            log.debug('Alma environment: %s', self.ils.name)
+    def select_record(self, marc_record):
+        return self.selector.select_record(marc_record)
 
-        log.debug('Planned steps:')
-        for i, step in enumerate(self.steps):
-            log.debug(' %d. %s' % ((i + 1), step))
+    def search_records(self):
+        """
+        Yield (record, selected) tuples for the records from the search results.
+        """
+        records = self.sru.search(self.cql_query)
+        if self.match_processes > 1:
+            return select_records(self.selector, records, self.match_processes)
+        return ((marc_record, self.select_record(marc_record)) for marc_record in records)
+
+    def find_records(self):
+        """
+        Search SRU for the records to process. Returns an OrderedDict of MMS ID -> search
+        result record (only kept in list mode, otherwise None), or None if there were too many results.
+        """
 
         # ------------------------------------------------------------------------------------
         # Del 1: Søk mot SRU for å finne over alle bibliografiske poster med emneordet.
@@ -187,32 +321,18 @@ class Job(object):
         # I fremtiden, når vi får $0 på alle poster, kan vi bruke indeksen `alma.authority_id`
         # i stedet.
 
-        valid_records = set()
+        # MMS ID -> search result record. In list mode we keep the records from the search
+        # results and don't use the Bibs API at all.
+        valid_records = OrderedDict()
         pbar = None
 
         try:
-            for marc_record in self.sru.search(self.cql_query):
+            for marc_record, selected in self.search_records():
                 if pbar is None and self.show_progress and self.sru.num_records > 50:
                     pbar = tqdm(total=self.sru.num_records, desc='Filtering SRU results')
 
-                log.debug('Checking record %s', marc_record.id)
-                record_matching = False
-                grep_matching = False
-                for n, step in enumerate(self.steps):
-                    step_matching = step.match(marc_record)
-
-                    for field in marc_record.fields:
-                        if self.grep is None or self.grep in str(field).lower():
-                            grep_matching = True
-
-                    if step_matching:
-                        log.debug('Step %d did match', n)
-                        record_matching = True
-                    else:
-                        log.debug('Step %d did not match', n)
-
-                if record_matching and grep_matching:
-                    valid_records.add(marc_record.id)
+                if selected:
+                    valid_records[marc_record.id] = marc_record if self.action == 'list' else None
 
                 if pbar is not None:
                     pbar.update()
@@ -220,13 +340,31 @@ class Job(object):
                 pbar.close()
 
         except TooManyResults:
-            log.error((
-                'More than 10,000 results would have to be checked, but the Alma SRU service does '
-                'not allow us to retrieve more than 10,000 results. Annoying? Go vote for this:\n'
-                'http://ideas.exlibrisgroup.com/forums/308173-alma/suggestions/'
-                '18737083-sru-srw-increase-the-10-000-record-retrieval-limi'
-            ))
-            return []
+            log.error(TOO_MANY_RESULTS_MESSAGE)
+            return None
+
+        return valid_records
+
+    def start(self):
+
+        if self.ils.name is not None:
+            log.debug('Alma environment: %s', self.ils.name)
+
+        log.debug('Planned steps:')
+        for i, step in enumerate(self.steps):
+            log.debug(' %d. %s' % ((i + 1), step))
+
+        if self.journal is not None and self.journal.candidates is not None:
+            # Resuming a job: skip the search and the records that were already completed
+            valid_records = OrderedDict((mms_id, None) for mms_id in self.journal.pending())
+            log.info('Resuming job %s: %d of %d records already completed', self.journal.jobname,
+                     len(self.journal.candidates) - len(valid_records), len(self.journal.candidates))
+            if len(valid_records) == 0:
+                return valid_records
+        else:
+            valid_records = self.find_records()
+            if valid_records is None:
+                return []
 
         if len(valid_records) == 0:
             log.info('No matching catalog records found')
@@ -239,37 +377,127 @@ class Job(object):
             if self.dry_run:
                 log.warning('DRY RUN: No catalog records will actually be changed!')
 
-            if not self.dry_run and self.interactivity == INTERACTIVITY_STANDARD and not yesno('Continue?', default='yes'):
-                log.info('Job aborted')
-                return []
+            if not self.dry_run and self.interactivity == INTERACTIVITY_STANDARD:
+                if not yesno('Continue?', default='yes'):
+                    log.info('Job aborted')
+                    return []
+
+        if self.journal is not None and self.journal.candidates is None:
+            # Written once we're about to process the records, which also creates the journal file
+            self.journal.set_candidates(valid_records)
 
         # ------------------------------------------------------------------------------------
         # Del 2: Nå har vi en liste over MMS-IDer for bibliografiske poster vi vil endre.
+        # (I list-modus har vi allerede postene fra SRU, og trenger ikke Bib-apiet.)
         # Vi går gjennom dem én for én, henter ut posten med Bib-apiet, endrer og poster tilbake.
 
         self.records_changed = 0
         self.changes_made = 0
-        for idx, mms_id in enumerate(valid_records):
-            if self.action not in ['list', 'interactive']:
-                log.info('Record %d/%d: %s', idx + 1, len(valid_records), mms_id)
+        if self.action == 'list':
+            for idx, marc_record in enumerate(valid_records.values()):
+                progress = {'current': idx + 1, 'total': len(valid_records)}
+                self.show_record(marc_record, progress)
+                for step in self.steps:
+                    step.run(marc_record, progress)
+        elif self.workers > 1 and self.interactivity == INTERACTIVITY_NONE:
+            self.process_records_concurrently(list(valid_records))
+        else:
+            for idx, mms_id in enumerate(valid_records):
+                record = self.fetch_record(mms_id)
+                progress = {'current': idx + 1, 'total': len(valid_records)}
+                self.show_record(record.marc_record, progress)
+                self.count_changes(self.update_record(record, progress))
 
-            record = self.ils.get_record(mms_id)
+        return valid_records
 
-            if self.list_options.get('show_titles'):
-                utf8print('{}\t{}'.format(record.marc_record.id, record.marc_record.title()))
+    def export_records(self, writer):
+        """
+        Offline bulk edit: run the steps on the records from the record source directly,
+        and write the modified records to a MARCXML file for import into Alma, instead of
+        using the Bibs API. Records are processed one at a time, so memory use stays constant.
+        Returns the number of records written.
 
-            if self.list_options.get('show_subjects'):
-                for field in record.marc_record.fields:
-                    if field.tag.startswith('6'):
-                        if len(self.source_concepts) > 0 and field.sf('2') == self.source_concepts[0].sf['2']:
-                            utf8print('  {}{}{}'.format(Fore.YELLOW, field, Style.RESET_ALL))
-                        else:
-                            utf8print('  {}{}{}'.format(Fore.CYAN, field, Style.RESET_ALL))
+        :type writer: MarcXmlWriter
+        """
+        self.records_changed = 0
+        self.changes_made = 0
+        pbar = tqdm(desc='Processing records', unit=' records') if self.show_progress else None
 
-            c = self.update_record(record, progress={'current': idx + 1, 'total': len(valid_records)})
+        for marc_record in self.sru.search(self.cql_query):
+            if pbar is not None:
+                pbar.update()
+            if not self.match_record(marc_record):
+                continue
 
-            if c > 0:
-                self.records_changed += 1
-                self.changes_made += c
+            orig_hash = marc_record.content_hash()
+            changes = 0
+            for step in self.steps:
+                changes += step.run(marc_record)
 
-        return valid_records
+            if changes > 0 and marc_record.content_hash() == orig_hash:
+                log.info('Record %s ended up unchanged', marc_record.id)  # like in modify_record
+                changes = 0
+
+            if changes > 0:
+                log.debug('Record %s: %d changes', marc_record.id, changes)
+                diff = MarcDiff.from_changes(line_marc(marc_record.el), marc_record.changes)
+                writer.write(marc_record, changes, diff.lines())
+                self.count_changes(changes)
+
+        if pbar is not None:
+            pbar.close()
+
+        return self.records_changed
+
+    def process_records_concurrently(self, mms_ids):
+        """
+        Fetch, modify and store the records as a pipeline: a pool of worker threads
+        fetches records ahead of us and stores the modified ones, while the steps
+        are run here on the main thread in between. Only used in non-interactive mode.
+        """
+        records = imap_ordered(self.fetch_record, mms_ids, self.workers)
+        pending = deque()
+
+        def collect():
+            # Count a stored record, or run the steps again on a record that was changed in Alma
+            changes, progress, future = pending.popleft()
+            stored, fresh = future.result()
+            if fresh is not None:
+                changes = self.reconcile(fresh, progress)
+                if changes > 0:
+                    pending.append((changes, progress, executor.submit(self.store_record, fresh)))
+            elif stored:
+                self.count_changes(changes)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for idx, record in enumerate(records):
+                progress = {'current': idx + 1, 'total': len(mms_ids)}
+                self.show_record(record.marc_record, progress)
+                changes = self.modify_record(record, progress)
+                if changes > 0:
+                    pending.append((changes, progress, executor.submit(self.store_record, record)))
+                    while len(pending) > self.workers * 2:
+                        collect()
+
+            while pending:
+                collect()
+
+    def count_changes(self, changes):
+        if changes > 0:
+            self.records_changed += 1
+            self.changes_made += changes
+
+    def show_record(self, marc_record, progress):
+        if self.action not in ['list', 'interactive']:
+            log.info('Record %d/%d: %s', progress['current'], progress['total'], marc_record.id)
+
+        if self.list_options.get('show_titles'):
+            utf8print('{}\t{}'.format(marc_record.id, marc_record.title()))
+
+        if self.list_options.get('show_subjects'):
+            for field in marc_record.get_fields('6'):
+                if field.tag.startswith('6'):
+                    if len(self.source_concepts) > 0 and field.sf('2') == self.source_concepts[0].sf['2']:
+                        utf8print('  {}{}{}'.format(Fore.YELLOW, field, Style.RESET_ALL))
+                    else:
+                        utf8print('  {}{}{}'.format(Fore.CYAN, field, Style.RESET_ALL))
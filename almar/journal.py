@@ -0,0 +1,140 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Record statuses
+FETCHED = 'fetched'
+MODIFIED = 'modified'
+UNCHANGED = 'unchanged'
+PUT = 'put'
+FAILED = 'failed'
+ROLLED_BACK = 'rolled_back'
+CONFLICT = 'conflict'  # not rolled back, since the record was changed after the job
+
+COMPLETED = (UNCHANGED, PUT, ROLLED_BACK)  # rolled back records are not redone on resume
+
+
+class Journal(object):
+    """
+    On-disk progress log for a job, so that an interrupted job can be resumed.
+
+    The journal is a JSON lines file that is only ever appended to, with one
+    entry for the job itself, one for the candidate records found by the SRU
+    search and one for each status change of a record. A record is completed
+    once it has been stored (or found not to need any changes), so a resumed
+    job can skip both the SRU search and the completed records.
+
+    The file of a new job is only created when the first entry after the job
+    entry is written, so jobs that never get to process any records, like
+    aborted interactive sessions, don't leave a journal behind.
+
+    :param path: Path to the journal file. Entries already in the file are loaded.
+    """
+
+    extension = '.jsonl'
+
+    def __init__(self, path):
+        self.path = path
+        self.jobname = os.path.basename(path)[:-len(self.extension)]
+        self.argv = None
+        self.candidates = None  # list of MMS IDs, or None if the SRU search has not completed
+        self.status = OrderedDict()  # MMS ID -> last status
+        self.preimages = OrderedDict()  # MMS ID -> (pre-image key, content hash after the PUT)
+        self.header = None  # the job entry of a new job, until the file is created
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.load()
+
+    @property
+    def preimages_path(self):
+        # Directory for the PreimageStore of the job
+        return self.path[:-len(self.extension)] + '.preimages'
+
+    @classmethod
+    def create(cls, job_dir, jobname, argv):
+        journal = cls(os.path.join(job_dir, jobname + cls.extension))
+        journal.header = {'event': 'job', 'argv': argv, 'time': time.time()}
+        journal.argv = argv
+        return journal
+
+    @classmethod
+    def find(cls, job_dir, jobname):
+        """
+        Find the journal of a job by its name, or by a unique prefix of it.
+        Returns None if no such journal exists.
+        """
+        if not os.path.isdir(job_dir):
+            return None
+        matches = [
+            filename for filename in os.listdir(job_dir)
+            if filename.startswith(jobname) and filename.endswith(cls.extension)
+        ]
+        if len(matches) != 1:
+            if len(matches) > 1:
+                log.error('"%s" matches more than one job', jobname)
+            return None
+        return cls(os.path.join(job_dir, matches[0]))
+
+    def load(self):
+        with io.open(self.path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning('Ignoring incomplete journal entry: %s', line.strip())
+                    continue  # most likely the last line, if we crashed while writing it
+                if entry['event'] == 'job':
+                    self.argv = entry['argv']
+                elif entry['event'] == 'candidates':
+                    self.candidates = entry['records']
+                elif entry['event'] == 'record':
+                    self.status[entry['id']] = entry['status']
+                    if entry.get('preimage') is not None:
+                        self.preimages[entry['id']] = (entry['preimage'], entry.get('hash'))
+
+    def write(self, entry):
+        entry['time'] = time.time()
+        entries = [entry]
+        with self.lock:
+            if self.header is not None:
+                job_dir = os.path.dirname(self.path)
+                if not os.path.isdir(job_dir):
+                    os.makedirs(job_dir)
+                entries.insert(0, self.header)
+                self.header = None
+            with io.open(self.path, 'a', encoding='utf-8') as fp:
+                for entry in entries:
+                    fp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def set_candidates(self, mms_ids):
+        self.candidates = list(mms_ids)
+        self.write({'event': 'candidates', 'records': self.candidates})
+
+    def set_status(self, mms_id, status, **kwargs):
+        """
+        Log the status of a record, with optional extra data like the diff.
+        """
+        self.status[mms_id] = status
+        entry = {'event': 'record', 'id': mms_id, 'status': status}
+        entry.update(kwargs)
+        if entry.get('preimage') is not None:
+            self.preimages[mms_id] = (entry['preimage'], entry.get('hash'))
+        self.write(entry)
+
+    def completed(self, mms_id):
+        return self.status.get(mms_id) in COMPLETED
+
+    def pending(self):
+        """
+        Return the candidate records that have not been completed yet.
+        """
+        return [mms_id for mms_id in self.candidates or [] if not self.completed(mms_id)]
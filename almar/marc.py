@@ -3,12 +3,15 @@ from __future__ import unicode_literals
 
 import warnings
 import logging
+import weakref
 from collections import OrderedDict
 from copy import deepcopy
+from hashlib import sha1
 
 from six import python_2_unicode_compatible
+from six.moves import intern
 
-from .util import term_match, parse_xml, ANY_VALUE
+from .util import etree, term_match, parse_xml, line_field, ANY_VALUE
 
 log = logging.getLogger(__name__)
 
@@ -31,6 +34,9 @@ def deprecated(func):
 @python_2_unicode_compatible
 class Subfield(object):
     """ A Marc21 subfield """
+
+    __slots__ = ('node',)
+
     def __init__(self, node):
         self.node = node
 
@@ -63,8 +69,17 @@ class Subfield(object):
 class Field(object):
     """ A Marc21 field """
 
-    def __init__(self, node):
+    __slots__ = ('node', '_record')
+
+    def __init__(self, node, record=None):
         self.node = node
+        # A weak reference to the Record this field belongs to, if any, so that the
+        # record's field index doesn't keep the record alive through a reference cycle
+        self._record = None if record is None else weakref.ref(record)
+
+    @property
+    def record(self):
+        return None if self._record is None else self._record()
 
     @property
     def tag(self):
@@ -95,8 +110,9 @@ class Field(object):
 
     def sf(self, code=None):
         # return text of first matching subfield or None
-        for node in self.get_subfields(code):
-            return node.text
+        for node in self.node.iterchildren('subfield'):
+            if code is None or code == node.get('code'):
+                return node.text
 
     @deprecated  # use sf instead
     def subfield_text(self, code):
@@ -106,6 +122,9 @@ class Field(object):
         if self.node.get('tag') != value:
             log.debug('CHANGE: Set tag to %s in `%s`', value, self)
             self.node.set('tag', value)
+            record = self.record
+            if record is not None:
+                record.invalidate_index()
             return 1
         return 0
 
@@ -127,32 +146,15 @@ class Field(object):
         """
         Return True if 'field' matches this concept
         """
-
-        if not self.tag.startswith(concept.tag):
-            return False
-
-        if concept.ind1 != '?' and self.ind1 != concept.ind1:
-            return False
-
-        if concept.ind2 != '?' and self.ind2 != concept.ind2:
-            return False
-
-        for code, sf_value in concept.sf.items():
-            if sf_value != ANY_VALUE and not term_match(sf_value, self.sf(code)):
-                return False
-
-        if not ignore_extra_subfields:
-            for subfield in self.subfields:
-                if subfield.code not in concept.sf and subfield.code not in ['0', '9']:
-                    return False
-
-        return True
+        return concept.matcher().match(self.node, ignore_extra_subfields)
 
     def replace(self, source, target):
         """
         Replace field with target
         """
 
+        record = self.record
+        original = deepcopy(self.node) if record is not None else None
         modified = 0
 
         modified += self.set_tag(target.tag)
@@ -160,6 +162,9 @@ class Field(object):
         modified += self.set_ind2(target.ind2)
         modified += self.update_subfields(source, target)
 
+        if modified > 0 and record is not None:
+            record.log_change(Change(Change.MODIFIED, self.node, original))
+
         return modified
 
     def update_subfields(self, source, target):
@@ -199,12 +204,80 @@ class Field(object):
         return modified
 
 
+class Change(object):
+    """
+    A change made to a field of a Record: the field node, and for removed
+    and modified fields, a copy of the node from before the change and its
+    position in the record.
+    """
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+
+    __slots__ = ('action', 'node', 'original', 'index', 'before', 'after')
+
+    def __init__(self, action, node, original=None, index=None):
+        self.action = action
+        self.node = node
+        self.original = original
+        self.index = index
+        self.before = None if original is None else line_field(original)
+        self.after = None if action == self.REMOVED else line_field(node)
+
+    def __repr__(self):
+        return 'Change(%s, %r, %r)' % (self.action, self.before, self.after)
+
+    def undo(self, record):
+        if self.action == self.ADDED:
+            record.el.remove(self.node)
+        elif self.action == self.REMOVED:
+            record.el.insert(self.index, self.node)
+        else:
+            # Restore the node in place, since earlier changes refer to it
+            self.node.attrib.clear()
+            self.node.attrib.update(self.original.attrib)
+            self.node[:] = [deepcopy(child) for child in self.original]
+
+
+class FieldIndex(object):
+    """ Fields of a Record, in document order and grouped by tag """
+
+    __slots__ = ('fields', 'by_tag', 'subjects')
+
+    def __init__(self, record):
+        self.fields = []
+        self.by_tag = {}
+        self.subjects = []  # 6XX
+        for node in record.el.iterchildren('datafield'):
+            field = Field(node, record)
+            tag = intern(node.get('tag'))  # share the keys between records
+            self.fields.append(field)
+            self.by_tag.setdefault(tag, []).append(field)
+            if tag.startswith('6'):
+                self.subjects.append(field)
+
+    def get(self, tag=None):
+        if not tag:
+            return self.fields
+        if len(tag) == 3:
+            return self.by_tag.get(tag, [])
+        if tag == '6':
+            return self.subjects
+        return [field for field in self.fields if field.tag.startswith(tag)]
+
+
 class Record(object):
     """ A Marc21 record """
 
+    __slots__ = ('el', '_index', '_changes', 'quiet', '__weakref__')
+
     def __init__(self, el):
         # el: xml.etree.ElementTree.Element
         self.el = el
+        self._index = None  # FieldIndex, built on first use
+        self._changes = None  # list of Change, created on the first change
+        self.quiet = False  # set for records that are only dry-run, to keep the changes out of the log
 
     @property
     def id(self):
@@ -214,22 +287,68 @@ class Record(object):
     def fields(self):
         return self.get_fields()
 
-    def get_fields(self):
-        for node in self.el.findall('datafield'):
-            yield Field(node)
+    def get_fields(self, tag=None):
+        """
+        Return the data fields, optionally only those having a tag starting with `tag`.
+        """
+        if self._index is None:
+            self._index = FieldIndex(self)
+        return iter(self._index.get(tag))
+
+    def invalidate_index(self):
+        # Must be called whenever fields are added, removed or change tag.
+        self._index = None
+
+    def content_hash(self):
+        """
+        SHA-1 of the MARC content of the record: the leader, the control fields and
+        the data fields, independent of formatting.
+        """
+        digest = sha1()
+        for node in self.el.iterchildren(etree.Element):
+            if node.tag == 'datafield':
+                digest.update(line_field(node).encode('utf-8'))
+            else:
+                digest.update(('%s %s %s\n' % (node.tag, node.get('tag', ''), node.text or '')).encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def changes(self):
+        """
+        The changes made to the fields of the record, in order.
+
+        :rtype: list of Change
+        """
+        return self._changes or []
+
+    def log_change(self, change):
+        if self._changes is None:
+            self._changes = []
+        self._changes.append(change)
+
+    def undo(self, count=None):
+        """
+        Undo the last `count` changes, or all the changes. Returns the number of changes undone.
+        """
+        changes = self.changes
+        count = len(changes) if count is None else min(count, len(changes))
+        for _ in range(count):
+            changes.pop().undo(self)
+        self.invalidate_index()
+        return count
 
     def search(self, concept, ignore_extra_subfields=False):
         """
         Return fields matching the Concept
         """
-        for field in self.fields:
+        for field in self.get_fields(concept.tag):
             if field.match(concept, ignore_extra_subfields):
                 yield field
 
     def remove_duplicates(self, concept, ignore_extra_subfields=False):
         concept = deepcopy(concept)
 
-        concept.sf['0'] = ANY_VALUE
+        concept.set_subfield('0', ANY_VALUE)
 
         dups = 0
         candidates = {}
@@ -250,7 +369,8 @@ class Record(object):
             # Sort fields with $0 first, since we prefer to keep those
             matches = sorted(matches, key=lambda x: x.sf('0') or '', reverse=True)
             for match in matches[1:]:
-                log.info('Target subject already existed on the record, ignoring duplicate: %s', match)
+                log.log(logging.DEBUG if self.quiet else logging.INFO,
+                        'Target subject already existed on the record, ignoring duplicate: %s', match)
                 self.remove_field(match)
                 dups += 1
 
@@ -258,7 +378,31 @@ class Record(object):
 
     def remove_field(self, field):
         # field: Field
+        self.log_change(Change(Change.REMOVED, field.node, field.node, self.el.index(field.node)))
         self.el.remove(field.node)
+        self.invalidate_index()
+
+    def add_field(self, node):
+        """
+        Insert a datafield node after the last field having a tag lower than
+        or equal to its tag.
+        """
+        tag = int(node.get('tag'))
+        last_field = None
+        for field in self.fields:
+            try:
+                field_tag = int(field.tag)
+            except ValueError:  # Alma includes non-numeric tags like 'AVA'
+                continue
+
+            if field_tag > tag:
+                break
+            last_field = field
+
+        idx = 0 if last_field is None else self.el.index(last_field.node)
+        self.el.insert(idx + 1, node)
+        self.log_change(Change(Change.ADDED, node))
+        self.invalidate_index()
 
     def title(self):
 
@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import gzip
+import io
+import logging
+
+from .marc import Record
+from .sru import MARC_NS
+from .util import etree, strip_namespace
+
+log = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_file(path):
+    # Open a file for binary reading, transparently decompressing it if it's gzipped
+    fp = io.open(path, 'rb')
+    magic = fp.read(2)
+    fp.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    return fp
+
+
+class MarcXmlReader(object):
+    """
+    Record source reading MARCXML collection files, like the ones produced by
+    Alma publishing profiles, as an alternative to searching SRU. The files may
+    be gzipped. Records are parsed one at a time with iterparse, so there's no
+    limit on the file size, and no limit on the number of records.
+
+    Since we can't evaluate CQL, the query is ignored, and all the records are
+    returned. They are then filtered by the job steps as usual, which is why
+    `--file` can't be combined with `--cql` or with jobs that only add terms.
+
+    :param paths: List of files to read
+    """
+
+    name = None
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.record_no = 0
+        self.num_records = 0  # unknown until we're done
+
+    def search(self, query=None):
+        self.record_no = 0
+        for path in self.paths:
+            log.info('Reading records from %s', path)
+            with open_file(path) as fp:
+                for record in self.read(fp):
+                    self.record_no += 1
+                    yield record
+        self.num_records = self.record_no
+
+    @staticmethod
+    def read(fp):
+        for _, node in etree.iterparse(fp, events=('end',), tag=['{%s}record' % MARC_NS, 'record'],
+                                       remove_blank_text=True):
+            # Detach the record from the collection, so we don't keep the whole
+            # file in memory, but the caller may keep the record.
+            parent = node.getparent()
+            if parent is not None:
+                parent.remove(node)
+            yield Record(strip_namespace(node, MARC_NS))
@@ -0,0 +1,123 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import itertools
+import logging
+from collections import deque
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .marc import Record
+from .util import etree, imap_ordered
+
+log = logging.getLogger(__name__)
+
+
+class RecordSelector(object):
+    """
+    Decides which records from the search results a job should process.
+    Only holds the steps and options needed for that, so it can be sent to
+    worker processes.
+    """
+
+    def __init__(self, action, steps, grep=None):
+        self.action = action
+        self.steps = steps
+        self.grep = grep
+
+    def match_record(self, marc_record):
+        """
+        Check if a record from the search results should be processed.
+        """
+        log.debug('Checking record %s', marc_record.id)
+        record_matching = False
+        for n, step in enumerate(self.steps):
+            if step.match(marc_record):
+                log.debug('Step %d did match', n)
+                record_matching = True
+            else:
+                log.debug('Step %d did not match', n)
+
+        if not record_matching:
+            return False
+
+        if self.grep is None:
+            return any(True for _ in marc_record.fields)  # records without data fields never matched
+
+        return any(self.grep in str(field).lower() for field in marc_record.fields)
+
+    def would_change(self, marc_record):
+        """
+        Dry-run the steps on a record from the search results, so we don't fetch
+        records from the Bibs API that wouldn't be changed anyway. The search
+        result record is thrown away afterwards, so it's fine to modify it.
+        """
+        if self.action in ['list', 'interactive']:
+            return True
+
+        log.debug('Checking if the steps would change record %s', marc_record.id)
+        marc_record.quiet = True  # the changes are logged when the record is modified for real
+        changes = 0
+        for step in self.steps:
+            changes += step.run(marc_record)
+
+        if changes == 0:
+            log.debug('Record %s matched, but would not be changed', marc_record.id)
+        return changes > 0
+
+    def select_record(self, marc_record):
+        return self.match_record(marc_record) and self.would_change(marc_record)
+
+
+class BatchSelector(object):
+    """
+    Selects the records that any of the selectors would select. Each selector
+    dry-runs its steps on its own copy of the record, so the steps from one job
+    don't affect what the next job sees.
+    """
+
+    def __init__(self, selectors):
+        self.selectors = selectors
+
+    def match_record(self, marc_record):
+        return any(selector.match_record(marc_record) for selector in self.selectors)
+
+    def select_record(self, marc_record):
+        return any(
+            selector.match_record(marc_record) and selector.would_change(Record(deepcopy(marc_record.el)))
+            for selector in self.selectors
+        )
+
+
+def select_chunk(selector, chunk):
+    # Runs in the worker processes. The records are serialized, since lxml trees can't be pickled.
+    return [selector.select_record(Record(etree.fromstring(xml))) for xml in chunk]
+
+
+def select_records(selector, records, workers, chunk_size=100):
+    """
+    Run the selector on the records in a pool of worker processes, and yield
+    (record, selected) tuples in the same order as the records.
+
+    The records are sent to the workers in chunks of `chunk_size` serialized records,
+    and the workers work on their own copies, so the records we yield are not
+    modified by would_change().
+
+    :type selector: RecordSelector
+    """
+    records = iter(records)
+    pending = deque()  # the chunks sent to the workers, in order
+
+    def chunks():
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                return
+            pending.append(chunk)
+            yield [etree.tostring(record.el) for record in chunk]
+
+    results = imap_ordered(partial(select_chunk, selector), chunks(), workers, executor_class=ProcessPoolExecutor)
+    for selected in results:
+        for record, is_selected in zip(pending.popleft(), selected):
+            yield record, is_selected
@@ -0,0 +1,121 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import logging
+from datetime import date
+
+from .sru import MAX_RECORDS, TooManyResults
+from .util import imap_ordered
+
+log = logging.getLogger(__name__)
+
+
+class QueryPartitioner(object):
+    """
+    Splits a CQL query matching more than MAX_RECORDS records into disjoint
+    sub-queries that can each be retrieved in full from SRU.
+
+    The query is split on ranges of publication years, which are bisected
+    until each range matches few enough records. Records without a (valid)
+    publication year are covered by a final residual query.
+
+    :param sru: SruClient
+    :param index: CQL index to split on. Must support the >= and <= relations.
+    :param first: First year of the full range
+    :param last: Last year of the full range. Default: next year
+    """
+
+    def __init__(self, sru, index='alma.main_pub_date', first=0, last=None, max_records=MAX_RECORDS):
+        self.sru = sru
+        self.index = index
+        self.first = first
+        self.last = last or date.today().year + 1
+        self.max_records = max_records
+
+    def range_query(self, query, first, last):
+        return '({query}) AND {index}>={first} AND {index}<={last}'.format(
+            query=query, index=self.index, first=first, last=last)
+
+    def residual_query(self, query):
+        return '({query}) NOT ({index}>={first} AND {index}<={last})'.format(
+            query=query, index=self.index, first=self.first, last=self.last)
+
+    def partitions(self, query):
+        """
+        Return a list of (query, number of records) tuples for the non-empty partitions.
+        Raises TooManyResults if the query cannot be split small enough.
+        """
+        count = self.sru.count(query)
+        if count <= self.max_records:
+            return [(query, count)]
+
+        log.info('The query matches %d records, splitting it on %s', count, self.index)
+        partitions = self.split(query, self.first, self.last)
+
+        residual = self.residual_query(query)
+        residual_count = self.sru.count(residual)
+        if residual_count > self.max_records:
+            log.error('%d records are missing %s, so the query cannot be split further', residual_count, self.index)
+            raise TooManyResults()
+        if residual_count > 0:
+            partitions.append((residual, residual_count))
+
+        log.info('Split the query into %d parts', len(partitions))
+        return partitions
+
+    def split(self, query, first, last):
+        part = self.range_query(query, first, last)
+        count = self.sru.count(part)
+        if count == 0:
+            return []
+        if count <= self.max_records:
+            return [(part, count)]
+        if first == last:
+            log.error('%d records have %s=%d, so the query cannot be split further', count, self.index, first)
+            raise TooManyResults()
+
+        middle = (first + last) // 2
+        return self.split(query, first, middle) + self.split(query, middle + 1, last)
+
+
+class PartitionedSruClient(object):
+    """
+    Wraps an SruClient to search queries matching more than MAX_RECORDS records,
+    by splitting them into partitions and merging the results. Records found in more
+    than one partition are only returned once.
+
+    :param sru: SruClient
+    :param workers: Number of partitions to search concurrently
+    """
+
+    def __init__(self, sru, workers=1, partitioner=None):
+        self.sru = sru
+        self.workers = workers
+        self.partitioner = partitioner or QueryPartitioner(sru)
+        self.name = sru.name
+        self.num_records = 0  # total for all the partitions
+
+    @property
+    def record_no(self):
+        return self.sru.record_no
+
+    def search_partition(self, query):
+        return list(self.sru.search(query))
+
+    def search(self, query):
+        partitions = self.partitioner.partitions(query)
+        self.num_records = sum(count for _, count in partitions)
+
+        if self.workers > 1 and len(partitions) > 1:
+            results = imap_ordered(self.search_partition, [part for part, _ in partitions], self.workers)
+        else:
+            results = (self.sru.search(part) for part, _ in partitions)
+
+        seen = set()
+        for records in results:
+            for record in records:
+                if record.id in seen:
+                    log.debug('Skipping duplicate record %s', record.id)
+                    continue
+                seen.add(record.id)
+                yield record
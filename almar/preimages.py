@@ -0,0 +1,61 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import gzip
+import io
+import logging
+import os
+import tempfile
+from hashlib import sha1
+
+from six import text_type
+
+log = logging.getLogger(__name__)
+
+
+class PreimageStore(object):
+    """
+    Content-addressed store for the records as they were before a job changed
+    them, so that the job can be rolled back. Each record is stored gzipped in
+    a file named by the SHA-1 of its content, so storing the same record twice
+    (like when a job is resumed) takes no extra space.
+
+    :param path: Directory to store the records in. Created if it doesn't exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.xml.gz')
+
+    def put(self, data):
+        """
+        Store a record, and return its key.
+
+        :param data: The record as XML (bytes or text)
+        """
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        key = sha1(data).hexdigest()
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return key
+
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)  # records are stored concurrently
+
+        # Write to a temporary file first, so that a crash never leaves a truncated record behind
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with io.open(fd, 'wb') as fp:
+            with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+                gz.write(data)
+        os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        """
+        Return the record stored with the given key as bytes.
+        """
+        with gzip.open(self.get_path(key), 'rb') as fp:
+            return fp.read()
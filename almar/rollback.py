@@ -0,0 +1,97 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import logging
+from collections import Counter
+
+from requests import RequestException
+from tqdm import tqdm
+
+from .bib import Bib
+from .journal import FAILED, ROLLED_BACK, CONFLICT
+from .util import imap_ordered
+
+log = logging.getLogger(__name__)
+
+
+class Rollback(object):
+    """
+    Restores the records changed by a job to how they were before the job,
+    using the pre-images stored while the job ran.
+
+    A record is only restored if it hasn't been changed since the job stored
+    it, which is checked by comparing the content hash logged by the job with
+    the content hash of a freshly fetched copy. Records that were changed are
+    reported as conflicts, and left alone unless `force` is set.
+
+    :param journal: Journal of the job to roll back
+    :param preimages: PreimageStore of the job
+    :param ils: Alma
+    :param workers: Number of records to restore concurrently
+    """
+
+    def __init__(self, journal, preimages, ils, workers=1, force=False, dry_run=False, show_progress=True):
+        self.journal = journal
+        self.preimages = preimages
+        self.ils = ils
+        self.workers = workers
+        self.force = force
+        self.dry_run = dry_run
+        self.show_progress = show_progress
+
+    def pending(self):
+        """
+        Return the records stored by the job that have not been rolled back yet.
+        """
+        return [mms_id for mms_id in self.journal.preimages if self.journal.status.get(mms_id) != ROLLED_BACK]
+
+    def rollback_record(self, mms_id):
+        """
+        Restore a single record. Returns its new status.
+        """
+        key, content_hash = self.journal.preimages[mms_id]
+        try:
+            current = self.ils.get_record(mms_id, fresh=True)
+        except RequestException as err:
+            log.error('Failed to fetch record %s: %s', mms_id, err)
+            return FAILED
+
+        if current.marc_record.content_hash() != content_hash:
+            if not self.force:
+                log.warning('Record %s was changed after the job, not rolling it back', mms_id)
+                return CONFLICT
+            log.warning('Record %s was changed after the job, rolling it back anyway', mms_id)
+
+        record = Bib(self.preimages.get(key))
+        if self.dry_run:
+            log.info('Would restore record %s', mms_id)
+            return ROLLED_BACK
+
+        if not self.ils.put_record(record, interactive=False):
+            return FAILED
+
+        log.info('Restored record %s', mms_id)
+        return ROLLED_BACK
+
+    def start(self):
+        """
+        Roll back all the records. Returns a Counter of the resulting statuses.
+        """
+        mms_ids = self.pending()
+        log.info('Rolling back %d records changed by job %s', len(mms_ids), self.journal.jobname)
+
+        statuses = Counter()
+        pbar = tqdm(total=len(mms_ids), desc='Rolling back', unit=' records') if self.show_progress else None
+        results = imap_ordered(self.rollback_record, mms_ids, self.workers)
+        for mms_id, status in zip(mms_ids, results):
+            statuses[status] += 1
+            if not self.dry_run:
+                self.journal.set_status(mms_id, status)
+            if pbar is not None:
+                pbar.update()
+        if pbar is not None:
+            pbar.close()
+
+        log.info('Rolled back %d records, %d conflicts, %d failed',
+                 statuses[ROLLED_BACK], statuses[CONFLICT], statuses[FAILED])
+        return statuses
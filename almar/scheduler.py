@@ -0,0 +1,138 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import logging
+import random
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing on average `rate` calls to acquire()
+    per second, with bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token if one is available and return 0, otherwise return the number
+        of seconds to wait before trying again. Never blocks, so it can also be used
+        from the event loop.
+        """
+        with self.lock:
+            now = self.clock()
+            self.refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1 - 1e-9:  # allow for rounding errors
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if wait == 0:
+                return
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        # Stop handing out tokens to anyone for a while, e.g. after a 429 response.
+        with self.lock:
+            now = self.clock()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated = now
+
+
+class RequestScheduler(object):
+    """
+    Sends requests through a token bucket, so that we stay within the API call
+    quota of the Alma institution, and retries requests that were rejected
+    because of the quota anyway (429 Too Many Requests).
+
+    The retry delay is taken from the Retry-After header if present, otherwise
+    we use exponential backoff with jitter. The delay is applied by pausing the
+    bucket, so that parallel workers back off together. Since 429 responses are sent
+    before the request is processed, and PUTs to the Bibs API replace the
+    whole record anyway, both GETs and PUTs are safe to retry.
+
+    :param transport: Transport
+    :param rate: Requests per second. Alma allows 25 per institution.
+    :param max_retries: Give up after this many retries and return the last response.
+    """
+
+    retry_statuses = (429,)
+
+    def __init__(self, transport, rate=25, max_retries=5, backoff_factor=1.0, max_backoff=60,
+                 clock=time.monotonic, sleep=time.sleep, bucket=None):
+        self.transport = transport
+        self.bucket = bucket or TokenBucket(rate, clock=clock, sleep=sleep)  # may be shared between schedulers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    def get_delay(self, headers, attempt):
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None:
+            if retry_after.strip().isdigit():
+                return float(retry_after)
+            parsed = parsedate_tz(retry_after)
+            if parsed is not None:
+                return max(0.0, mktime_tz(parsed) - time.time())
+
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def is_retryable(text):
+        # The daily quota won't recover in time to help us.
+        return 'DAILY_THRESHOLD' not in text
+
+    def should_retry(self, status, attempt):
+        return status in self.retry_statuses and attempt < self.max_retries
+
+    def backoff(self, method, url, status, headers, attempt):
+        """
+        Pause the bucket before retrying a rejected request.
+        """
+        delay = self.get_delay(headers, attempt)
+        log.warning('Got HTTP %d from %s %s, retrying in %.1f seconds', status, method, url, delay)
+        self.bucket.pause(delay)  # the next acquire() will wait
+
+    def request(self, method, url, **kwargs):
+        data = kwargs.get('data')
+        attempt = 0
+        while True:
+            if hasattr(data, 'seek'):
+                data.seek(0)  # rewind the request body if we're retrying
+            self.bucket.acquire()
+            response = self.transport.request(method, url, **kwargs)
+            if not self.should_retry(response.status_code, attempt) or not self.is_retryable(response.text):
+                return response
+
+            self.backoff(method, url, response.status_code, response.headers, attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
@@ -0,0 +1,226 @@
+# coding=utf-8
+"""
+Local vocabularies: authorize terms against a vocabulary dump instead of an
+ID lookup service. Supported formats:
+
+- JSON lines (.jsonl, .ndjson): one concept per line, with `id`, `prefLabel`,
+  and optionally `altLabel` and `notation`. Labels can be strings, lists of
+  strings or dicts of language code -> string(s).
+- SKOS as RDF/XML (.rdf, .xml, .owl)
+- SKOS as Turtle (.ttl). Requires rdflib.
+
+The files may be gzipped.
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+
+from six import string_types
+
+from .authorities import Vocabulary
+from .marcxml import open_file
+from .util import etree, normalize_term
+
+try:
+    import rdflib
+except ImportError:
+    rdflib = None
+
+log = logging.getLogger(__name__)
+
+NS = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'xml': 'http://www.w3.org/XML/1998/namespace',
+}
+
+
+def label_values(labels, language=None):
+    # Flatten the label formats we accept in JSON lines files to a list of strings
+    if labels is None:
+        return []
+    if isinstance(labels, string_types):
+        return [labels]
+    if isinstance(labels, dict):
+        return [
+            value for lang, values in labels.items() if language is None or lang == language
+            for value in label_values(values)
+        ]
+    return list(labels)
+
+
+class LocalVocabulary(Vocabulary):
+    """
+    Vocabulary that authorizes terms against an in-memory index of preferred
+    labels, alternative labels and notations, without any network requests.
+    Labels are normalized with normalize_term, like when matching fields.
+
+    :param marc_code: Vocabulary code, as used in $2
+    :param language: Only index labels in this language. Default: all languages
+    """
+
+    remote = False
+
+    def __init__(self, marc_code, language=None):
+        super(LocalVocabulary, self).__init__(marc_code)
+        self.language = language
+        self.ids = []  # concept number -> identifier
+        self.pref_labels = []  # concept number -> preferred label
+        self.labels = {}  # normalized label -> concept number
+        self.notations = {}  # notation -> concept number
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_concept(self, identifier, pref_labels, alt_labels=(), notations=()):
+        if len(pref_labels) == 0:
+            return
+        n = len(self.ids)
+        self.ids.append(identifier)
+        self.pref_labels.append(pref_labels[0])
+        for label in alt_labels:
+            self.labels.setdefault(normalize_term(label), n)
+        for label in pref_labels:
+            self.labels[normalize_term(label)] = n  # preferred labels win over alternative labels
+        for notation in notations:
+            self.notations[notation] = n
+
+    def authorize_term(self, term, tag):
+        if term == '':
+            return {}
+
+        n = self.labels.get(normalize_term(term))
+        if n is None:
+            n = self.notations.get(term)
+        if n is None:
+            log.debug('Term not found in local vocabulary %s: %s', self.marc_code, term)
+            return {}
+
+        if normalize_term(self.pref_labels[n]) != normalize_term(term) and term not in self.notations:
+            log.warning('"%s" is not a preferred term, the preferred term is "%s"', term, self.pref_labels[n])
+
+        return {'id': self.ids[n], 'prefLabel': self.pref_labels[n]}
+
+    # ------------------------------------------------------------------------------------
+    # Loading and saving
+
+    @classmethod
+    def from_file(cls, marc_code, path, index_path=None, language=None):
+        """
+        Load a vocabulary dump. If `index_path` is given, the index is saved there,
+        and loaded from there instead as long as it's newer than the dump and was
+        built for the same language.
+        """
+        if index_path is not None and os.path.exists(index_path) and \
+                os.path.getmtime(index_path) >= os.path.getmtime(path):
+            vocab = cls.load(marc_code, index_path)
+            if vocab.language == language:
+                return vocab
+            log.info('The index %s was built for another language, rebuilding it', index_path)
+
+        vocab = cls(marc_code, language)
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith('.jsonl') or name.endswith('.ndjson'):
+            vocab.read_jsonl(path)
+        elif name.endswith('.ttl'):
+            vocab.read_turtle(path)
+        else:
+            vocab.read_rdfxml(path)
+        log.info('Loaded %d concepts from %s', len(vocab), path)
+
+        if index_path is not None:
+            vocab.save(index_path)
+        return vocab
+
+    def read_jsonl(self, path):
+        with open_file(path) as fp:
+            for line in io.TextIOWrapper(fp, encoding='utf-8'):
+                if line.strip() == '':
+                    continue
+                concept = json.loads(line)
+                self.add_concept(
+                    concept['id'],
+                    label_values(concept.get('prefLabel'), self.language),
+                    label_values(concept.get('altLabel'), self.language),
+                    label_values(concept.get('notation')),
+                )
+
+    def get_labels(self, node, tag):
+        lang_attr = '{%s}lang' % NS['xml']
+        return [
+            label.text for label in node.iterchildren(tag)
+            if label.text and (self.language is None or label.get(lang_attr) in [None, self.language])
+        ]
+
+    def read_rdfxml(self, path):
+        with open_file(path) as fp:
+            for _, node in etree.iterparse(fp, events=('end',)):
+                parent = node.getparent()
+                if parent is None or parent.tag != '{%s}RDF' % NS['rdf']:
+                    continue
+
+                # A top level resource, like skos:Concept or rdf:Description
+                uri = node.get('{%s}about' % NS['rdf'])
+                identifier = node.findtext('dcterms:identifier', namespaces=NS) or uri
+                if identifier is not None:
+                    self.add_concept(
+                        identifier,
+                        self.get_labels(node, '{%s}prefLabel' % NS['skos']),
+                        self.get_labels(node, '{%s}altLabel' % NS['skos']),
+                        [notation.text for notation in node.iterchildren('{%s}notation' % NS['skos'])],
+                    )
+
+                # Free the parts of the tree we're done with
+                node.clear()
+                while node.getprevious() is not None:
+                    del parent[0]
+
+    def read_turtle(self, path):
+        if rdflib is None:
+            raise RuntimeError('Reading Turtle files requires rdflib. Install it with "pip install rdflib"')
+
+        skos = rdflib.Namespace(NS['skos'])
+        dcterms = rdflib.Namespace(NS['dcterms'])
+        graph = rdflib.Graph()
+        with open_file(path) as fp:
+            graph.parse(file=fp, format='turtle')
+
+        def labels(uri, predicate):
+            return [
+                '%s' % label for label in graph.objects(uri, predicate)
+                if self.language is None or getattr(label, 'language', None) in [None, self.language]
+            ]
+
+        for uri in set(graph.subjects(skos.prefLabel, None)):
+            identifier = graph.value(uri, dcterms.identifier)
+            self.add_concept(
+                '%s' % (identifier or uri),
+                labels(uri, skos.prefLabel),
+                labels(uri, skos.altLabel),
+                ['%s' % notation for notation in graph.objects(uri, skos.notation)],
+            )
+
+    @classmethod
+    def load(cls, marc_code, path):
+        with io.open(path, encoding='utf-8') as fp:
+            data = json.load(fp)
+        vocab = cls(marc_code, data.get('language'))
+        vocab.ids = data['ids']
+        vocab.pref_labels = data['prefLabels']
+        vocab.labels = data['labels']
+        vocab.notations = data['notations']
+        return vocab
+
+    def save(self, path):
+        with io.open(path, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({
+                'language': self.language,
+                'ids': self.ids,
+                'prefLabels': self.pref_labels,
+                'labels': self.labels,
+                'notations': self.notations,
+            }, ensure_ascii=False))
@@ -3,10 +3,10 @@ from __future__ import unicode_literals
 
 import logging
 
-import requests
-
+from .cache import namespaced
 from .marc import Record
-from .util import parse_xml
+from .transport import Transport
+from .util import etree, imap_ordered, strip_namespace
 
 log = logging.getLogger(__name__)
 
@@ -17,6 +17,10 @@ NSMAP = {
     'diag': 'http://www.loc.gov/zing/srw/diagnostic/',
 }
 
+MARC_NS = 'http://www.loc.gov/MARC21/slim'
+
+MAX_RECORDS = 10000  # Alma won't let us page past this
+
 
 class SruErrorResponse(RuntimeError):
     pass
@@ -26,61 +30,144 @@ class TooManyResults(RuntimeError):
     pass
 
 
+class SruPage(object):
+    """
+    A single searchRetrieve response, parsed incrementally.
+
+    Iterating over the page feeds the response to lxml in chunks and yields
+    (recordPosition, Record) tuples as soon as each record has been parsed.
+    Processed elements are cleared from the tree as we go, so only the
+    records still referenced by the caller are kept in memory.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, response):
+        self.response = response
+        self.num_records = None
+        self.next_record_position = None
+
+    def __iter__(self):
+        parser = etree.XMLPullParser(events=('end',), tag=[
+            '{%s}numberOfRecords' % NSMAP['srw'],
+            '{%s}record' % NSMAP['srw'],
+            '{%s}nextRecordPosition' % NSMAP['srw'],
+            '{%s}diagnostic' % NSMAP['diag'],
+        ])
+        for offset in range(0, len(self.response), self.chunk_size):
+            parser.feed(self.response[offset:offset + self.chunk_size])
+            for item in self.process_events(parser):
+                yield item
+        parser.close()
+        for item in self.process_events(parser):
+            yield item
+
+    def process_events(self, parser):
+        for _, node in parser.read_events():
+            tag = etree.QName(node).localname
+
+            if tag == 'diagnostic':
+                raise SruErrorResponse(node.findtext('diag:message', namespaces=NSMAP))
+
+            elif tag == 'numberOfRecords':
+                self.num_records = int(node.text)
+                if self.num_records > MAX_RECORDS:
+                    raise TooManyResults()
+
+            elif tag == 'nextRecordPosition':
+                if node.text:
+                    self.next_record_position = int(node.text)
+
+            elif tag == 'record':
+                position = int(node.findtext('srw:recordPosition', namespaces=NSMAP))
+
+                # Fix for the sudden addition of namespaces to the SRU response.
+                # The problem is that the Bibs API still don't use namespaces,
+                # so by removing the namespace the XML is compatible with the Bibs API.
+                marc_record = node.find('srw:recordData/*', namespaces=NSMAP)
+                marc_record.getparent().remove(marc_record)
+                strip_namespace(marc_record, MARC_NS)
+
+                # Free the parts of the tree we're done with
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+
+                yield position, Record(marc_record)
+
+
 class SruClient(object):
 
-    def __init__(self, endpoint_url, cache, name=None, cache_time=300):
+    def __init__(self, endpoint_url, cache, name=None, cache_time=300, workers=1, transport=None):
         self.endpoint_url = endpoint_url
-        self.cache = cache
+        self.transport = transport or Transport()
+        self.cache = namespaced(cache, 'sru', cache_time)
         self.cache_time = cache_time
         self.name = name
+        self.workers = workers  # number of pages to fetch concurrently
         self.record_no = 0  # from last response
         self.num_records = 0  # from last response
 
-    def request_and_cache(self, query, start_record, cache_key):
-        response = requests.get(self.endpoint_url, params={
+    def get_page(self, query, start_record, headers=None):
+        return self.transport.get(self.endpoint_url, params={
             'version': '1.2',
             'operation': 'searchRetrieve',
             'startRecord': start_record,
             'maximumRecords': '50',
             'query': query,
-        })
-        response.raise_for_status()
-        self.cache.set(cache_key, response.text, expire=self.cache_time)
-        return response.text
+        }, headers=headers)
 
     def request(self, query, start_record):
-        cache_key = 'sru:{}:{}'.format(query, start_record)
-
-        return self.cache.get(cache_key) or self.request_and_cache(query, start_record, cache_key)
+        cache_key = '{}:{}'.format(query, start_record)
+
+        return self.cache.fetch(cache_key, lambda headers: self.get_page(query, start_record, headers))
+
+    def count(self, query):
+        """
+        Return the number of records matching the query, also when there are more than MAX_RECORDS.
+        The first page is cached, so it's not wasted if we search for the query afterwards.
+        """
+        page = SruPage(self.request(query, 1))
+        try:
+            for _ in page:
+                break  # numberOfRecords comes before the records
+        except TooManyResults:
+            pass
+        return page.num_records or 0
+
+    def page_records(self, page):
+        for position, record in page:
+            self.num_records = page.num_records
+            self.record_no = position
+            yield record
+        self.num_records = page.num_records
 
     def search(self, query):
         log.debug('SRU search: %s', query)
         # A searchRetrieve generator that yields MarcRecord objects
-        start_record = 1
-        while True:
-            response = self.request(query, start_record)
-
-            # Fix for the sudden addition of namespaces to the SRU response.
-            # The problem is that the Bibs API still don't use namespaces,
-            # so by removing the namespace the XML is compatible with the Bibs API.
-            txt = response.replace('xmlns="http://www.loc.gov/MARC21/slim"', 'xmlns=""')
-
-            root = parse_xml(txt)  # Takes ~ 4 seconds for 50 records!
-
-            for diagnostic in root.findall('srw:diagnostics/diag:diagnostic', namespaces=NSMAP):
-                raise SruErrorResponse(diagnostic.findtext('diag:message', namespaces=NSMAP))
-
-            self.num_records = int(root.findtext('srw:numberOfRecords', namespaces=NSMAP))
-            if self.num_records > 10000:
-                raise TooManyResults()
-
-            for record in root.iterfind('srw:records/srw:record', namespaces=NSMAP):
-                self.record_no = int(record.findtext('srw:recordPosition', namespaces=NSMAP))
-
-                yield Record(record.find('srw:recordData/record', namespaces=NSMAP))
-
-            nrp = root.find('srw:nextRecordPosition', namespaces=NSMAP)
-            if nrp is not None:
-                start_record = nrp.text
-            else:
-                break  # Enden er nær, den er faktisk her!
+        page = SruPage(self.request(query, 1))
+        for record in self.page_records(page):
+            yield record
+
+        start_record = page.next_record_position
+        if start_record is None:
+            return  # Everything fit on the first page
+
+        if self.workers > 1:
+            # The first page told us how many records there are and how many we get
+            # per page, so we can request all the remaining pages up front and let a
+            # pool of workers fetch them while we're parsing.
+            page_size = start_record - 1
+            # Use the count from our own page: other searches (like other partitions) may share this client
+            positions = range(start_record, page.num_records + 1, page_size)
+            responses = imap_ordered(lambda pos: self.request(query, pos), positions, self.workers)
+            for response in responses:
+                for record in self.page_records(SruPage(response)):
+                    yield record
+            return
+
+        while start_record is not None:
+            page = SruPage(self.request(query, start_record))
+            for record in self.page_records(page):
+                yield record
+            start_record = page.next_record_position  # None: Enden er nær, den er faktisk her!
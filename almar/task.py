@@ -40,7 +40,7 @@ class SingleSourceConceptTask(Task):
         self.ignore_extra_subfields = ignore_extra_subfields
 
     def match(self, marc_record):
-        for field in marc_record.fields:
+        for field in marc_record.get_fields(self.source.tag):
             if field.tag.startswith('6') and field.match(self.source, self.ignore_extra_subfields):
                 return True
         return False
@@ -57,7 +57,7 @@ class MultipleSourceConceptTask(Task):
         self.ignore_extra_subfields = ignore_extra_subfields
 
     def match_concept(self, marc_record, concept):
-        for field in marc_record.fields:
+        for field in marc_record.get_fields(concept.tag):
             if field.tag.startswith('6') and field.match(concept, self.ignore_extra_subfields):
                 return True
         return False
@@ -90,7 +90,7 @@ class ReplaceTask(SingleSourceConceptTask):
         """
         if self.ignore_extra_subfields:
             if '0' in self.target.sf:
-                del self.target.sf['0']
+                self.target.remove_subfield('0')
 
     def __str__(self):
         ign = ' (ignoring any extra subfields)' if self.ignore_extra_subfields else ''
@@ -140,7 +140,7 @@ class InteractiveReplaceTask(SingleSourceConceptTask):
         utf8print('{}{} {}{}'.format(
             Fore.WHITE, marc_record.id, marc_record.title(), Style.RESET_ALL
         ))
-        for field in marc_record.fields:
+        for field in marc_record.get_fields('6'):
             if field.tag.startswith('6'):
                 if field.sf('2') == self.source.sf['2']:
                     if field.match(self.source):
@@ -210,7 +210,7 @@ class ListTask(MultipleSourceConceptTask):
         #     utf8print(marc_record.id)
 
         if self.show_subjects:
-            for field in marc_record.fields:
+            for field in marc_record.get_fields('6'):
                 if field.tag.startswith('6'):
                     for concept in self.concepts:
                         if field.sf('2') == concept.sf['2']:
@@ -270,18 +270,7 @@ class AddTask(Task):
     def _run(self, marc_record):
         new_field = self.target.as_xml()
 
-        idx = 0
-        for field in marc_record.fields:
-            try:
-                node_tag = int(field.tag)
-            except ValueError:  # Alma includes non-numeric tags like 'AVA'
-                continue
-
-            if node_tag > int(self.target.tag):
-                break
-            idx = marc_record.el.index(field.node)
-
-        marc_record.el.insert(idx + 1, new_field)
+        marc_record.add_field(new_field)
         log.debug('Inserting field: %s' % self.target)
 
         marc_record.remove_duplicates(self.target)
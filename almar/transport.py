@@ -0,0 +1,84 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import logging
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+
+class Transport(object):
+    """
+    HTTP transport shared by the SRU client, the Alma client and the
+    authority services, so that they all reuse pooled keep-alive connections
+    instead of setting up a new TCP+TLS connection for every request.
+
+    :param pool_size: Max number of connections to keep alive per host.
+    :param host_pool_sizes: Dict of hostname -> pool size for hosts that need
+                            a different pool size than the default.
+    :param retries: Number of times to retry failed connections and
+                    responses with a status code in `status_forcelist`.
+    :param backoff_factor: Sleep `backoff_factor * 2^(retry number - 1)`
+                           seconds between retries.
+    :param timeout: Default timeout in seconds for each request.
+    """
+
+    def __init__(self, pool_size=10, host_pool_sizes=None, retries=3, backoff_factor=0.5,
+                 status_forcelist=(502, 503, 504), timeout=60):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.timeout = timeout
+
+        self.session = Session()
+        self.session.mount('https://', self.make_adapter(pool_size))
+        self.session.mount('http://', self.make_adapter(pool_size))
+        for host, host_pool_size in (host_pool_sizes or {}).items():
+            log.debug('Using pool size %d for %s', host_pool_size, host)
+            self.session.mount('https://%s/' % host, self.make_adapter(host_pool_size))
+            self.session.mount('http://%s/' % host, self.make_adapter(host_pool_size))
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a transport from the `http` section of the configuration file.
+        """
+        return cls(
+            pool_size=int(config.get('pool_size', 10)),
+            host_pool_sizes={host: int(size) for host, size in (config.get('hosts') or {}).items()},
+            retries=int(config.get('retries', 3)),
+            backoff_factor=float(config.get('backoff_factor', 0.5)),
+            timeout=float(config.get('timeout', 60)),
+        )
+
+    def make_retry(self):
+        # PUTs to the Bibs API replace the whole record, so they are safe to retry.
+        # Rate limiting (429 + Retry-After) is left to the RequestScheduler.
+        options = {
+            'total': self.retries,
+            'backoff_factor': self.backoff_factor,
+            'status_forcelist': self.status_forcelist,
+            'raise_on_status': False,
+            'respect_retry_after_header': False,
+        }
+        try:
+            return Retry(allowed_methods=frozenset(['GET', 'HEAD', 'PUT']), **options)
+        except TypeError:  # urllib3 < 1.26
+            return Retry(method_whitelist=frozenset(['GET', 'HEAD', 'PUT']), **options)
+
+    def make_adapter(self, pool_size):
+        return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self.make_retry())
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
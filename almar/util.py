@@ -1,12 +1,13 @@
 # coding=utf-8
 from __future__ import unicode_literals
-import difflib
+import itertools
 import sys
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import vkbeautify
 from colorama import Fore
 from lxml import etree
-from six import text_type
+from six import python_2_unicode_compatible, text_type
 import questionary
 import logging
 import re
@@ -60,12 +61,54 @@ def pick_one(msg, options, alpha_options=None):
     return choices[answer]
 
 
+def imap_ordered(func, items, workers, buffer_size=None, executor_class=ThreadPoolExecutor):
+    """
+    Like map(), but calls func concurrently from a pool of worker threads
+    (or processes, with executor_class=ProcessPoolExecutor).
+    At most `buffer_size` calls are in flight at any time, and the results
+    are yielded in the same order as the items.
+    """
+    buffer_size = buffer_size or workers * 2
+    items = iter(items)
+    pending = deque()
+    with executor_class(max_workers=workers) as executor:
+        try:
+            for item in itertools.islice(items, buffer_size):
+                pending.append(executor.submit(func, item))
+            while pending:
+                result = pending.popleft().result()
+                for item in itertools.islice(items, 1):
+                    pending.append(executor.submit(func, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def parse_xml(txt):
+    # Bytes are parsed as they are. Text is encoded first, since lxml refuses
+    # text with an encoding declaration.
     if isinstance(txt, text_type):
         return etree.fromstring(txt.encode('utf-8'))
     return etree.fromstring(txt)
 
 
+def strip_namespace(root, namespace):
+    # Move all elements in the given namespace to the empty namespace, in place.
+    for node in root.iter('{%s}*' % namespace):
+        node.tag = etree.QName(node).localname
+    etree.cleanup_namespaces(root)
+    return root
+
+
+def add_namespace(root, namespace):
+    # Move all elements in the empty namespace to the given namespace, in place.
+    for node in root.iter(etree.Element):
+        if etree.QName(node).namespace is None:
+            node.tag = '{%s}%s' % (namespace, node.tag)
+    return root
+
+
 def normalize_term(term):
     # Normalize term so it starts with a capital letter. If the term is a subject string
     # fused by " : ", normalize all components.
@@ -92,28 +135,116 @@ def color_diff(diff):
             yield line
 
 
-def line_marc(root):
-
-    st = []
-    for node in root.xpath('//datafield'):
-        t = '%s %s%s' % (node.get('tag'), node.get('ind1').replace(' ', '#'), node.get('ind2').replace(' ', '#'))
-        for sf in node.findall('subfield'):
-            t += ' $%s %s' % (sf.get('code'), sf.text)
-        t += '\n'
-        st.append(t)
-
-    return st
+def line_field(node):
+    # A datafield node as a line, like "650 #7 $a Term $2 noubomn\n"
+    t = '%s %s%s' % (node.get('tag'), node.get('ind1').replace(' ', '#'), node.get('ind2').replace(' ', '#'))
+    for sf in node.findall('subfield'):
+        t += ' $%s %s' % (sf.get('code'), sf.text)
+    return t + '\n'
 
 
-def get_diff(src, dst):
-    src = sorted(line_marc(etree.fromstring(src.encode('utf-8'))))
-    dst = sorted(line_marc(etree.fromstring(dst.encode('utf-8'))))
-
-    # src = vkbeautify.xml(src).splitlines(True)
-    # dst = vkbeautify.xml(dst).splitlines(True)
-
-    # returns list of unicode strings
-    return list(difflib.unified_diff(src, dst, fromfile='Original', tofile='Modified'))
+def line_marc(root):
+    return [line_field(node) for node in root.iter('datafield')]
+
+
+@python_2_unicode_compatible
+class MarcDiff(object):
+    """
+    Field level diff of two versions of a record, from the lines produced by
+    line_marc. Since the order of the fields doesn't matter, the diff is just
+    the multiset difference of the lines in each direction, so it's computed
+    in linear time. It's only rendered to text when needed, so it can be passed
+    to the log functions as an argument.
+
+    :param src: Lines of the original record
+    :param dst: Lines of the modified record
+    """
+
+    def __init__(self, src, dst):
+        src = Counter(src)
+        dst = Counter(dst)
+        self.unchanged = src & dst
+        self.removed = src - dst
+        self.added = dst - src
+
+    @classmethod
+    def from_changes(cls, lines, changes):
+        """
+        Diff from the current lines of a record and the changes made to it, see Record.changes.
+        """
+        src = Counter(lines)
+        for change in changes:
+            if change.after is not None:
+                src[change.after] -= 1
+            if change.before is not None:
+                src[change.before] += 1
+        return cls(+src, lines)
+
+    @property
+    def deletions(self):
+        return sum(self.removed.values())
+
+    @property
+    def additions(self):
+        return sum(self.added.values())
+
+    def __bool__(self):
+        return len(self.removed) > 0 or len(self.added) > 0
+
+    __nonzero__ = __bool__
+
+    def lines(self, context=3):
+        """
+        Render the diff as a list of lines in the unified diff format: the sorted fields,
+        with the removed fields prefixed with '-' and the added fields with '+', and up to
+        `context` unchanged fields around them.
+        """
+        if not self:
+            return []
+        lines = sorted(
+            [(line, '-') for line in self.removed.elements()] +
+            [(line, '+') for line in self.added.elements()] +
+            [(line, ' ') for line in self.unchanged.elements()]
+        )
+
+        # Group the changed lines into hunks, merging hunks whose context overlaps
+        hunks = []
+        for idx, (_, prefix) in enumerate(lines):
+            if prefix == ' ':
+                continue
+            start, end = max(0, idx - context), min(len(lines), idx + context + 1)
+            if hunks and start <= hunks[-1][1]:
+                hunks[-1][1] = end
+            else:
+                hunks.append([start, end])
+
+        out = ['--- Original\n', '+++ Modified\n']
+        src_pos = dst_pos = 0
+        cursor = 0
+        for start, end in hunks:
+            src_pos += start - cursor  # the lines between the hunks are unchanged
+            dst_pos += start - cursor
+            hunk = lines[start:end]
+            src_len = sum(1 for _, prefix in hunk if prefix != '+')
+            dst_len = sum(1 for _, prefix in hunk if prefix != '-')
+            out.append('@@ -%s +%s @@\n' % (format_range(src_pos, src_len), format_range(dst_pos, dst_len)))
+            out.extend(prefix + line for line, prefix in hunk)
+            src_pos += src_len
+            dst_pos += dst_len
+            cursor = end
+        return out
+
+    def __str__(self):
+        return format_diff(self.lines())
+
+
+def format_range(start, length):
+    # Line range of a hunk, formatted like difflib.unified_diff does
+    if length == 1:
+        return '%d' % (start + 1)
+    if length == 0:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
 
 
 def format_diff(lines):
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Measure the size of the response cache and the time it takes to load and
+parse cached Bib records, for each way of storing them:
+
+- text: uncompressed text, parsed with parse_xml (the old way)
+- zlib: zlib-compressed bytes, parsed directly by lxml
+- zstd: zstd-compressed bytes, parsed directly by lxml (if zstandard is installed)
+
+Usage::
+
+    python benchmarks/cache.py [--copies 2000] [bib.xml ...]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import glob
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from diskcache import Cache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from almar.bib import Bib  # noqa: E402
+from almar.cache import ResponseCache, zstandard  # noqa: E402
+
+DEFAULT_FILES = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'data', 'bib_*.xml'))
+
+
+def fill(cache, responses, as_text):
+    for n, response in enumerate(responses):
+        cache.set(str(n), response.decode('utf-8') if as_text else response)
+
+
+def load(cache, count):
+    for n in range(count):
+        Bib(cache.get(str(n)))
+
+
+def run(name, responses, codec, as_text):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with Cache(cache_dir) as store:
+            cache = ResponseCache(store, 'bib', codec=codec)
+            if codec is None:
+                cache.encode = lambda value: (None, value)  # store as is
+
+            fill(cache, responses, as_text)
+            t0 = time.time()
+            load(cache, len(responses))
+            dt = time.time() - t0
+
+            print('%-5s %8.1f MB %8.0f bytes/record %8.1f µs/record' % (
+                name,
+                store.volume() / 1024. / 1024.,
+                float(store.volume()) / len(responses),
+                dt / len(responses) * 1e6,
+            ))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('files', nargs='*', default=DEFAULT_FILES, help='Bib API responses')
+    parser.add_argument('--copies', type=int, default=2000, help='Number of copies of each record')
+    args = parser.parse_args()
+
+    responses = []
+    for filename in args.files:
+        with io.open(filename, 'rb') as fp:
+            responses.append(fp.read())
+    responses = responses * args.copies
+
+    print('Records: %d' % len(responses))
+    run('text', responses, None, as_text=True)
+    run('zlib', responses, 'zlib', as_text=False)
+    if zstandard is not None:
+        run('zstd', responses, 'zstd', as_text=False)
+    else:
+        print('zstd  (zstandard is not installed)')
+
+
+if __name__ == '__main__':
+    main()
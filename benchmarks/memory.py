@@ -0,0 +1,87 @@
+# coding=utf-8
+"""
+Measure the per-record memory overhead of the MARC wrappers.
+
+Parses the records of an SRU response, makes `--copies` copies of them and
+keeps them all alive, like we do when buffering search results. Then runs a
+typical matching pass over the records twice and reports, per record:
+
+- retained: memory held by the wrappers after the first pass
+  (field index, Field objects, compiled matchers)
+- transient: peak amount of short-lived memory allocated during the
+  second pass (wrappers, generators, etc.)
+
+Usage::
+
+    python benchmarks/memory.py [--copies 2000] [sru_response.xml]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import sys
+import tracemalloc
+from collections import OrderedDict
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from almar.concept import Concept  # noqa: E402
+from almar.marc import Record  # noqa: E402
+from almar.sru import SruPage  # noqa: E402
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'data',
+                            'sru_sample_response_1.xml')
+
+
+def load_records(filename, copies):
+    with io.open(filename, encoding='utf-8') as fp:
+        records = [record for _, record in SruPage(fp.read())]
+    return [Record(deepcopy(record.el)) for _ in range(copies) for record in records]
+
+
+def matching_pass(records, concepts):
+    matches = 0
+    for record in records:
+        for concept in concepts:
+            for field in record.search(concept, ignore_extra_subfields=True):
+                matches += 1
+                field.sf('a')
+        for field in record.get_fields('6'):
+            for subfield in field.subfields:
+                subfield.code
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('file', nargs='?', default=DEFAULT_FILE, help='SRU response')
+    parser.add_argument('--copies', type=int, default=2000, help='Number of copies of each record')
+    args = parser.parse_args()
+
+    records = load_records(args.file, args.copies)
+    concepts = [
+        Concept('650', OrderedDict([('a', 'Atferd'), ('2', 'noubomn')])),
+        Concept('650', OrderedDict([('a', 'Mønstre'), ('x', 'Dagbøker'), ('2', 'noubomn')])),
+        Concept('655', OrderedDict([('a', 'Statistikk'), ('2', 'noubomn')])),
+    ]
+
+    tracemalloc.start()
+    matching_pass(records, concepts)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Restart tracing so that only allocations made during the second pass are counted
+    tracemalloc.start()
+    matching_pass(records, concepts)
+    transient = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print('Records:   %d' % len(records))
+    print('Retained:  %7.0f bytes/record' % (float(retained) / len(records)))
+    print('Transient: %7.0f bytes' % transient)
+
+
+if __name__ == '__main__':
+    main()
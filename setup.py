@@ -35,6 +35,10 @@ setup(name='almar',
                         'questionary',
                         'diskcache',
                         ],
+      extras_require={
+          'async': ['aiohttp'],
+          'zstd': ['zstandard'],
+      },
       setup_requires=['pytest-runner'],
       tests_require=['pytest', 'pytest-pycodestyle', 'pytest-cov', 'responses', 'mock'],
       entry_points={'console_scripts': ['almar=almar.almar:main']},
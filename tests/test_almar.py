@@ -1,11 +1,17 @@
 # encoding=utf-8
 from __future__ import unicode_literals
 
+import asyncio
+import gc
+import gzip
 import json
 import os
 import re
+import shutil
 import sys
+import tempfile
 import unittest
+import weakref
 from collections import OrderedDict
 
 import pytest
@@ -20,18 +26,40 @@ from contextlib import contextmanager
 from functools import wraps
 from textwrap import dedent
 from diskcache import Cache
+from requests import HTTPError
 
 from almar.bib import Bib
 from almar.almar import run, get_config, job_args, parse_args, get_concept
-from almar.authorities import Vocabulary
-from almar.sru import SruClient, SruErrorResponse, TooManyResults, NSMAP
+from almar.authorities import Authorities, Vocabulary
+from almar.sru import SruClient, SruPage, SruErrorResponse, TooManyResults, NSMAP
 from almar.alma import Alma
+from almar.transport import Transport
+from almar.scheduler import RequestScheduler, TokenBucket
 from almar.job import Job
+from almar.journal import Journal, PUT, ROLLED_BACK, CONFLICT
+from almar.export import MarcXmlWriter
+from almar.marcxml import MarcXmlReader
+from almar.preimages import PreimageStore
+from almar.rollback import Rollback
+from almar.partition import QueryPartitioner, PartitionedSruClient
 from almar.concept import Concept
-from almar.util import normalize_term, parse_xml, ANY_VALUE, INTERACTIVITY_NONE
+from almar.batch import BatchJob, read_mapping
+from almar.cache import ResponseCache, get_store_settings
+from almar.skos import LocalVocabulary
+from almar.util import etree, MarcDiff, normalize_term, term_match, parse_xml, ANY_VALUE, INTERACTIVITY_NONE
 from almar.marc import Record
+from almar.matching import RecordSelector
 from almar.task import DeleteTask, ReplaceTask, AddTask
 
+try:
+    import aiohttp
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from almar.aio import (AsyncAlma, AsyncAuthorities, AsyncJob, AsyncRequestScheduler, AsyncSruClient,
+                           AsyncVocabulary, create_session)
+except (ImportError, SyntaxError):  # aiohttp not installed or Python < 3.6
+    aiohttp = None
+
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
@@ -42,6 +70,24 @@ def get_cache_mock():
     return cache
 
 
+class FakeClock(object):
+    # Clock for the rate limiting tests, where sleeping just moves the time forward
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds):
+        self.sleep(seconds)
+
+
 def get_sample(filename, as_xml=False):
     with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data/%s' % filename), encoding='utf-8') as fp:
         body = fp.read()
@@ -126,6 +172,32 @@ class TestRecord(unittest.TestCase):
         record = self.getRecord()
         assert 'A : B. P. N / C. 2003' == record.title()
 
+    def testFieldIndex(self):
+        record = self.getRecord()
+        assert [field.tag for field in record.get_fields('6')] == ['650'] * 6 + ['648', '655', '653']
+        assert len(list(record.get_fields('650'))) == 6
+        assert len(list(record.get_fields('65'))) == 8
+        assert len(list(record.get_fields('700'))) == 0
+
+        # The index must follow changes to the record
+        field = next(record.get_fields('648'))
+        field.set_tag('651')
+        assert len(list(record.get_fields('648'))) == 0
+        assert len(list(record.get_fields('651'))) == 1
+
+        record.remove_field(field)
+        assert len(list(record.get_fields('651'))) == 0
+
+        record.add_field(Concept('651', {'a': 'Oslo', '2': 'noubomn'}).as_xml())
+        assert [field.tag for field in record.get_fields('65')] == ['650'] * 6 + ['651', '655', '653']
+
+    def testFieldWrappersAreCompact(self):
+        record = self.getRecord()
+        fields = list(record.get_fields('650'))
+        assert [id(field) for field in record.get_fields('650')] == [id(field) for field in fields]
+        for obj in [record, fields[0], next(fields[0].subfields), Concept('650', {'a': 'Test', '2': 'noubomn'})]:
+            assert not hasattr(obj, '__dict__')
+
     def testFind650a(self):
         """
         1st field should not match because of $2
@@ -407,6 +479,88 @@ class TestRecord(unittest.TestCase):
         assert modified == 1
         assert len(bib.doc.findall('record/datafield[@tag="650"]')) == 1
 
+        diff = bib.diff()
+        assert (diff.deletions, diff.additions) == (1, 0)
+        assert diff.lines() == [
+            '--- Original\n',
+            '+++ Modified\n',
+            '@@ -1,2 +1 @@\n',
+            ' 650 #7 $a Monstre $2 noubomn\n',
+            '-650 #7 $a Mønstre $2 noubomn\n',
+        ]
+        assert '650 #7 $a Mønstre' in '%s' % diff
+
+    def testDiffOnlyHasContextAroundTheChanges(self):
+        src = ['%03d #7 $a Term\n' % tag for tag in range(600, 620)]
+        dst = src[:2] + src[3:] + ['650 #7 $a New\n']
+        assert MarcDiff(src, dst).lines() == [
+            '--- Original\n',
+            '+++ Modified\n',
+            '@@ -1,6 +1,5 @@\n',
+            ' 600 #7 $a Term\n',
+            ' 601 #7 $a Term\n',
+            '-602 #7 $a Term\n',
+            ' 603 #7 $a Term\n',
+            ' 604 #7 $a Term\n',
+            ' 605 #7 $a Term\n',
+            '@@ -18,3 +17,4 @@\n',
+            ' 617 #7 $a Term\n',
+            ' 618 #7 $a Term\n',
+            ' 619 #7 $a Term\n',
+            '+650 #7 $a New\n',
+        ]
+
+    def testChangeLogAndUndo(self):
+        bib = Bib("""
+            <bib>
+                <record>
+                  <datafield ind1=" " ind2="7" tag="650">
+                    <subfield code="a">Mønstre</subfield>
+                    <subfield code="2">noubomn</subfield>
+                  </datafield>
+                  <datafield ind1=" " ind2="7" tag="650">
+                    <subfield code="a">Fysikk</subfield>
+                    <subfield code="2">noubomn</subfield>
+                  </datafield>
+                </record>
+            </bib>
+        """)
+        original = etree.tostring(bib.doc)
+
+        ReplaceTask(
+            Concept('650', OrderedDict((('a', 'Mønstre'), ('2', 'noubomn')))),
+            Concept('651', OrderedDict((('a', 'Monstre'), ('2', 'noubomn'))))
+        ).run(bib.marc_record)
+        DeleteTask([Concept('650', OrderedDict((('a', 'Fysikk'), ('2', 'noubomn'))))]).run(bib.marc_record)
+        AddTask(Concept('650', OrderedDict((('a', 'Kjemi'), ('2', 'noubomn'))))).run(bib.marc_record)
+
+        changes = bib.marc_record.changes
+        assert [change.action for change in changes] == ['modified', 'removed', 'added']
+        assert changes[0].before == '650 #7 $a Mønstre $2 noubomn\n'
+        assert changes[0].after == '651 #7 $a Monstre $2 noubomn\n'
+        assert sorted(bib.diff().removed) == ['650 #7 $a Fysikk $2 noubomn\n', '650 #7 $a Mønstre $2 noubomn\n']
+        assert sorted(bib.diff().added) == ['650 #7 $a Kjemi $2 noubomn\n', '651 #7 $a Monstre $2 noubomn\n']
+
+        assert bib.marc_record.undo() == 3
+        assert etree.tostring(bib.doc) == original
+        assert bib.marc_record.changes == []
+        assert not bib.diff()
+        assert [field.tag for field in bib.marc_record.fields] == ['650', '650']
+
+    def testIndexedRecordIsFreedByRefcounting(self):
+        record = Record(parse_xml('<record><datafield ind1=" " ind2="7" tag="650"/></record>'))
+        field = next(record.get_fields('650'))
+        assert field.record is record
+
+        ref = weakref.ref(record)
+        gc.disable()
+        try:
+            del record
+            assert ref() is None
+        finally:
+            gc.enable()
+        assert field.record is None
+
     def testDuplicatesAreRemovedIgnoreD0(self):
         # Two fields are considered duplicates even if one doesn't have a $0 value
         bib = Bib("""
@@ -466,6 +620,88 @@ class TestRecord(unittest.TestCase):
         assert len(bib.doc.findall('record/datafield[@tag="648"]')) == 0
         assert len(bib.doc.findall('record/datafield[@tag="650"]')) == 1
 
+    def testDryRunDoesNotLogDuplicates(self):
+        # The duplicate is only logged when the record is modified for real, not while filtering
+        bib = Bib("""
+            <bib>
+                <record>
+                  <controlfield tag="001">1</controlfield>
+                  <datafield ind1=" " ind2="7" tag="650">
+                    <subfield code="a">Mønstre</subfield>
+                    <subfield code="2">noubomn</subfield>
+                  </datafield>
+                  <datafield ind1=" " ind2="7" tag="650">
+                    <subfield code="a">Monstre</subfield>
+                    <subfield code="2">noubomn</subfield>
+                  </datafield>
+                </record>
+            </bib>
+        """)
+        task = ReplaceTask(
+            Concept('650', OrderedDict((('a', 'Mønstre'), ('2', 'noubomn')))),
+            Concept('650', OrderedDict((('a', 'Monstre'), ('2', 'noubomn'))))
+        )
+
+        with self.assertLogs('almar.marc', level='DEBUG') as logs:
+            assert RecordSelector('replace', [task]).would_change(Record(parse_xml(bib.xml()).find('record')))
+        assert 'INFO' not in [record.levelname for record in logs.records]
+
+        with self.assertLogs('almar.marc', level='DEBUG') as logs:
+            task.run(bib.marc_record)
+        assert 'INFO' in [record.levelname for record in logs.records]
+
+
+class TestConceptMatcher(unittest.TestCase):
+
+    @staticmethod
+    def reference_match(field, concept, ignore_extra_subfields):
+        # The original, uncompiled implementation of Field.match
+        if not field.tag.startswith(concept.tag):
+            return False
+        if concept.ind1 != '?' and field.ind1 != concept.ind1:
+            return False
+        if concept.ind2 != '?' and field.ind2 != concept.ind2:
+            return False
+        for code, sf_value in concept.sf.items():
+            if sf_value != ANY_VALUE and not term_match(sf_value, field.sf(code)):
+                return False
+        if not ignore_extra_subfields:
+            for subfield in field.subfields:
+                if subfield.code not in concept.sf and subfield.code not in ['0', '9']:
+                    return False
+        return True
+
+    def testSameResultsAsReferenceImplementation(self):
+        concepts = [
+            Concept('650', OrderedDict([('a', 'Statistiske modeller'), ('2', 'noubomn')])),
+            Concept('650', OrderedDict([('a', 'statistiske modeller'), ('0', ANY_VALUE), ('2', 'noubomn')])),
+            Concept('650', OrderedDict([('a', 'Økologi'), ('x', 'Statistiske modeller'), ('2', 'tekord')])),
+            Concept('650', OrderedDict([('a', 'Geologi'), ('x', None), ('2', 'tekord')]), ind2='7'),
+            Concept('6', OrderedDict([('a', ANY_VALUE), ('2', 'noubomn')])),
+            Concept('650', OrderedDict([('a', 'Geologi'), ('2', 'tekord')]), ind1='1'),
+        ]
+        records = list(SruPage(get_sample('sru_sample_response_1.xml')))
+        matches = 0
+        for _, record in records:
+            for field in record.fields:
+                for concept in concepts:
+                    for ignore in [False, True]:
+                        expected = self.reference_match(field, concept, ignore)
+                        assert field.match(concept, ignore) == expected, (str(field), str(concept), ignore)
+                        matches += expected
+        assert matches > 0
+
+    def testMatcherIsRecompiledWhenConceptChanges(self):
+        record = TestRecord.getRecord()
+        concept = Concept('650', OrderedDict([('a', 'Mønstre'), ('2', 'noubomn')]))
+        matcher = concept.matcher()
+        assert concept.matcher() is matcher
+        assert len(list(record.search(concept))) == 1
+
+        concept.set_subfield('a', 'Something else')
+        assert concept.matcher() is not matcher
+        assert len(list(record.search(concept))) == 0
+
 
 class TestRecordModifyIdentifiers(unittest.TestCase):
 
@@ -581,6 +817,22 @@ class TestSruSearch(unittest.TestCase):
         assert len(responses.calls) == 1
         assert len(records) == 18
 
+    def testStreamingPageKeepsYieldedRecords(self):
+        page = SruPage(get_sample('sru_sample_response_1.xml'))
+        page.chunk_size = 1000
+        records = list(page)
+
+        assert page.num_records == 18
+        assert page.next_record_position is None
+        assert [position for position, _ in records] == list(range(1, 19))
+
+        # Records must survive the clearing of the response tree, and the
+        # MARC namespace must be gone so they're compatible with the Bibs API.
+        record = records[0][1]
+        assert record.id == '990705558424702201'
+        assert record.el.tag == 'record'
+        assert len(list(record.fields)) > 0
+
     @responses.activate
     def testIteration(self):
         url = 'http://test/'
@@ -599,6 +851,37 @@ class TestSruSearch(unittest.TestCase):
         assert len(responses.calls) == 2
         assert len(records) == 2
 
+    @responses.activate
+    def testConcurrentIteration(self):
+        url = 'http://test/'
+
+        def request_callback(request):
+            if request.url.find('startRecord=2') != -1:
+                body = get_sample('sru_sample_response_3.xml')
+            else:
+                body = get_sample('sru_sample_response_2.xml')
+            return (200, {}, body)
+
+        responses.add_callback(responses.GET, url, callback=request_callback, content_type='application/xml')
+
+        sru = SruClient(url, get_cache_mock(), workers=4)
+        records = list(sru.search('alma.subjects=="test"'))
+
+        assert len(responses.calls) == 2
+        assert [record.id for record in records] == ['990314778524702201', '991343643254702201']
+        assert sru.record_no == 2
+
+        # A concurrent search on the same client (like another partition) doesn't affect the pages we fetch
+        page_records = sru.page_records
+
+        def interleaved_page_records(page):
+            for record in page_records(page):
+                yield record
+            sru.num_records = 0  # the other search got a page in the meantime
+
+        sru.page_records = interleaved_page_records
+        assert len(list(sru.search('alma.subjects=="test2"'))) == 2
+
     @responses.activate
     def testErrorResponse(self):
         url = 'http://test/'
@@ -625,6 +908,13 @@ class TestSruSearch(unittest.TestCase):
                 )
             )
 
+    @responses.activate
+    def testCountTooManyRecords(self):
+        url = 'http://test/'
+        responses.add(responses.GET, url, body=get_sample('sru_toomanyrecords.xml'), content_type='application/xml')
+
+        assert SruClient(url, get_cache_mock()).count('alma.subjects=="Tyskland"') == 12978
+
         assert len(responses.calls) == 1
 
 
@@ -652,7 +942,97 @@ class TestAlma(unittest.TestCase):
         alma.put_record(bib)
 
         assert len(responses.calls) == 1
-        assert responses.calls[0].request.body.read().decode('utf-8') == body
+        assert responses.calls[0].request.body == bib.xml()
+        assert parse_xml(responses.calls[0].request.body).findtext('mms_id') == id
+
+
+class TestTransport(unittest.TestCase):
+
+    def testHostPoolSizes(self):
+        transport = Transport.from_config({'pool_size': 4, 'hosts': {'api-eu.hosted.exlibrisgroup.com': 16}})
+
+        assert transport.session.get_adapter('https://example.com/sru')._pool_maxsize == 4
+        adapter = transport.session.get_adapter('https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/1')
+        assert adapter._pool_maxsize == 16
+
+    @patch('almar.alma.Transport')
+    @patch('almar.authorities.Transport')
+    def testTransportIsCreatedOnFirstUse(self, VocabularyTransport, AlmaTransport):
+        LocalVocabulary('noubomn')
+        alma = Alma('eu', 'secret', get_cache_mock())
+        vocabulary = Vocabulary('noubomn', 'http://example.com/{term}')
+        assert VocabularyTransport.call_count == 0
+        assert AlmaTransport.call_count == 0
+
+        assert alma.scheduler.transport is AlmaTransport.return_value
+        assert vocabulary.transport is vocabulary.transport
+        assert VocabularyTransport.call_count == 1
+
+    @responses.activate
+    def testApiKeyIsOnlySentToAlma(self):
+        transport = Transport()
+        alma = Alma('eu', 'secret', get_cache_mock(), transport=transport)
+        sru = SruClient('http://test/', get_cache_mock(), transport=transport)
+        responses.add(responses.GET, '{}/bibs/991416299674702204'.format(alma.base_url),
+                      body=get_sample('bib_991416299674702204.xml'), content_type='application/xml')
+        responses.add(responses.GET, 'http://test/',
+                      body=get_sample('sru_sample_response_1.xml'), content_type='application/xml')
+
+        alma.get_record('991416299674702204')
+        list(sru.search('alma.subjects=="test"'))
+
+        assert responses.calls[0].request.headers['Authorization'] == 'apikey secret'
+        assert 'Authorization' not in responses.calls[1].request.headers
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def testTokenBucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=2, clock=clock, sleep=clock.sleep)
+        for _ in range(12):
+            bucket.acquire()
+
+        # Two tokens from the initial burst, then 10 per second
+        assert clock.now == pytest.approx(1.0)
+
+    @responses.activate
+    def testRetryPutAfterTooManyRequests(self):
+        clock = FakeClock()
+        id = '991416299674702204'
+        body = get_sample('bib_991416299674702204.xml')
+        transport = Transport()
+        alma = Alma('test', 'key', get_cache_mock(), transport=transport,
+                    scheduler=RequestScheduler(transport, clock=clock, sleep=clock.sleep))
+        url = '{}/bibs/{}'.format(alma.base_url, id)
+        responses.add(responses.PUT, url, status=429, headers={'Retry-After': '2'}, body='PER_SECOND_THRESHOLD')
+        responses.add(responses.PUT, url, status=429, body='PER_SECOND_THRESHOLD')
+        responses.add(responses.PUT, url, body=body, content_type='application/xml')
+
+        alma.put_record(Bib(body))
+
+        assert len(responses.calls) == 3
+        assert clock.sleeps[0] == 2.0  # Retry-After
+        assert 1.0 <= clock.sleeps[1] <= 2.0  # backoff with jitter
+        for response_call in responses.calls:
+            request_body = response_call.request.body
+            if hasattr(request_body, 'read'):
+                request_body = request_body.read()
+            assert len(request_body) > 0  # body rewound for each attempt
+
+    @responses.activate
+    def testDailyThresholdIsNotRetried(self):
+        sleeps = []
+        transport = Transport()
+        alma = Alma('test', 'key', get_cache_mock(), transport=transport,
+                    scheduler=RequestScheduler(transport, sleep=sleeps.append))
+        responses.add(responses.GET, '{}/bibs/1'.format(alma.base_url), status=429, body='DAILY_THRESHOLD')
+
+        with pytest.raises(HTTPError):
+            alma.get_record('1')
+
+        assert len(responses.calls) == 1
+        assert sleeps == []
 
 
 class TestAuthorizeTerm(unittest.TestCase):
@@ -696,6 +1076,196 @@ class TestAuthorizeTerm(unittest.TestCase):
         assert len(responses.calls) == 0
 
 
+class TestAuthorities(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.cache = Cache(cache_dir)
+        self.addCleanup(self.cache.close)
+
+        self.vocab = Vocabulary('noubomn', 'http://example.com/?term={term}&tag={tag}')
+        self.vocab.authorize_term = MagicMock(side_effect=lambda term, tag: {
+            'Mønstre': {'id': 'REAL024436'},
+            'Monstre': {'error': 'Not found', 'uri': 'info:srw/diagnostic/1/61'},
+        }.get(term, {}))
+
+    def concept(self, term):
+        return Concept('650', OrderedDict([('a', term), ('2', 'noubomn')]))
+
+    def testCache(self):
+        for n in range(2):
+            authorities = Authorities({'noubomn': self.vocab}, cache=self.cache)
+            concepts = [self.concept('Mønstre'), self.concept('Monstre'), self.concept('Feil'), self.concept('Mønstre')]
+            for concept in concepts:
+                authorities.authorize_concept(concept)
+
+            assert [concept.sf.get('0') for concept in concepts] == ['REAL024436', None, None, 'REAL024436']
+
+        # The first run needs 3 lookups, the second run only needs to retry the failed lookup
+        assert self.vocab.authorize_term.call_count == 4
+        assert authorities.cache.get('noubomn:650:Mønstre') == {'id': 'REAL024436'}
+        assert authorities.cache.get('noubomn:650:Feil') is None
+
+    def testPrefetch(self):
+        authorities = Authorities({'noubomn': self.vocab})
+        concepts = [self.concept(term) for term in ['Mønstre', 'Monstre', 'Mønstre', 'Feil']]
+        concepts.append(Concept('650', OrderedDict([('a', 'Test'), ('2', 'unknown')])))
+        authorities.prefetch(concepts)
+        assert self.vocab.authorize_term.call_count == 3
+
+        for concept in concepts:
+            authorities.authorize_concept(concept)
+        assert self.vocab.authorize_term.call_count == 3
+        assert concepts[2].sf['0'] == 'REAL024436'
+
+
+class TestLocalVocabulary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def testRdfXml(self):
+        path = os.path.join(self.tmpdir, 'vocab.rdf.gz')
+        with gzip.open(path, 'wb') as fp:
+            fp.write(dedent("""\
+                <?xml version="1.0" encoding="UTF-8"?>
+                <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+                         xmlns:skos="http://www.w3.org/2004/02/skos/core#"
+                         xmlns:dcterms="http://purl.org/dc/terms/">
+                  <skos:Concept rdf:about="http://data.ub.uio.no/realfagstermer/c024436">
+                    <dcterms:identifier>REAL024436</dcterms:identifier>
+                    <skos:prefLabel xml:lang="nb">Mønstre</skos:prefLabel>
+                    <skos:prefLabel xml:lang="en">Patterns</skos:prefLabel>
+                    <skos:altLabel xml:lang="nb">mønster</skos:altLabel>
+                  </skos:Concept>
+                  <rdf:Description rdf:about="http://data.ub.uio.no/realfagstermer/c000001">
+                    <skos:prefLabel xml:lang="nb">Fysikk</skos:prefLabel>
+                    <skos:notation>530</skos:notation>
+                  </rdf:Description>
+                </rdf:RDF>
+            """).encode('utf-8'))
+
+        vocab = LocalVocabulary.from_file('noubomn', path, language='nb')
+
+        assert len(vocab) == 2
+        assert vocab.authorize_term('mønstre', '650') == {'id': 'REAL024436', 'prefLabel': 'Mønstre'}
+        assert vocab.authorize_term('Mønster', '650')['id'] == 'REAL024436'
+        assert vocab.authorize_term('Patterns', '650') == {}
+        assert vocab.authorize_term('530', '084')['id'] == 'http://data.ub.uio.no/realfagstermer/c000001'
+
+    def testJsonLinesWithIndex(self):
+        path = os.path.join(self.tmpdir, 'vocab.jsonl')
+        index_path = os.path.join(self.tmpdir, 'vocab.index.json')
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('{"id": "REAL024436", "prefLabel": {"nb": "Mønstre"}, "altLabel": ["Mønster"]}\n')
+            fp.write('{"id": "REAL000001", "prefLabel": "Fysikk", "notation": "530"}\n')
+
+        vocab = LocalVocabulary.from_file('noubomn', path, index_path=index_path)
+        assert os.path.exists(index_path)
+
+        with patch.object(LocalVocabulary, 'read_jsonl') as read_jsonl:
+            loaded = LocalVocabulary.from_file('noubomn', path, index_path=index_path)
+        read_jsonl.assert_not_called()
+
+        for term in ['Mønstre', 'mønster', 'Fysikk', '530', 'Kjemi']:
+            assert loaded.authorize_term(term, '650') == vocab.authorize_term(term, '650')
+        assert loaded.authorize_term('Mønster', '650')['id'] == 'REAL024436'
+
+        # The index is rebuilt if it was built for another language
+        with patch.object(LocalVocabulary, 'read_jsonl') as read_jsonl:
+            rebuilt = LocalVocabulary.from_file('noubomn', path, index_path=index_path, language='en')
+        read_jsonl.assert_called_once_with(path)
+        assert rebuilt.language == 'en'
+        assert LocalVocabulary.load('noubomn', index_path).language == 'en'
+
+    def testNotCached(self):
+        vocab = LocalVocabulary('noubomn')
+        vocab.add_concept('REAL024436', ['Mønstre'])
+        cache = Mock()
+        authorities = Authorities({'noubomn': vocab}, cache=cache)
+        concept = Concept('650', OrderedDict([('a', 'Mønstre'), ('2', 'noubomn')]))
+        authorities.authorize_concept(concept)
+
+        assert concept.sf['0'] == 'REAL024436'
+        cache.get.assert_not_called()
+        cache.set.assert_not_called()
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.store = Cache(cache_dir)
+        self.addCleanup(self.store.close)
+
+    def response(self, status_code=200, content=b'', headers=None):
+        return Mock(status_code=status_code, content=content, headers=headers or {})
+
+    def testNamespacesAndCompression(self):
+        sru_cache = ResponseCache(self.store, 'sru')
+        bib_cache = ResponseCache(self.store, 'bib')
+        query = 'alma.subjects="%s"' % ('x' * 300)
+        sru_cache.set(query, 'abc' * 1000)
+        bib_cache.set('1', '')
+
+        assert sru_cache.get(query) == 'abc' * 1000
+        assert bib_cache.get(query) is None
+        assert bib_cache.get('1') == ''  # empty responses are cached too
+        assert all(len(key) < 100 for key in self.store.iterkeys())
+        assert len(self.store.get(sru_cache.make_key(query))[-1]) < 100
+        assert sru_cache.stats()['hits'] == 1
+        assert bib_cache.stats() == {'hits': 1, 'misses': 1, 'revalidated': 0, 'hit_rate': 0.5}
+
+    def testRevalidation(self):
+        cache = ResponseCache(self.store, 'bib', expire=0)
+        request = Mock(side_effect=[
+            self.response(200, b'<record/>', {'ETag': '"v1"'}),
+            self.response(304),
+            self.response(200, b'<record>new</record>', {'ETag': '"v2"'}),
+        ])
+
+        assert cache.fetch('1', request) == b'<record/>'
+        assert cache.fetch('1', request) == b'<record/>'
+        assert cache.fetch('1', request) == b'<record>new</record>'
+
+        assert request.call_args_list == [call({}), call({'If-None-Match': '"v1"'}), call({'If-None-Match': '"v1"'})]
+        assert cache.stats()['revalidated'] == 1
+        assert cache.stats()['misses'] == 2
+
+    def testForcedRevalidation(self):
+        cache = ResponseCache(self.store, 'bib', expire=300)
+        request = Mock(side_effect=[self.response(200, b'<record/>', {'ETag': '"v1"'}), self.response(304)])
+
+        assert cache.fetch_item('1', request) == (b'<record/>', False)
+        assert cache.fetch_item('1', request) == (b'<record/>', True)
+        assert cache.fetch_item('1', request, revalidate=True) == (b'<record/>', False)
+        assert request.call_args_list == [call({}), call({'If-None-Match': '"v1"'})]
+
+    def testCodecs(self):
+        zlib_cache = ResponseCache(self.store, 'bib', codec='zlib')
+        zlib_cache.set('1', b'<record/>' * 100)
+        zlib_cache.set('2', '<record>ø</record>')
+
+        # Entries are read with the codec they were stored with
+        cache = ResponseCache(self.store, 'bib')
+        assert cache.get('1') == b'<record/>' * 100
+        assert cache.get('2') == '<record>ø</record>'
+
+        # Entries that can't be decoded are misses
+        self.store.set('bib:3', (0, None, None, None, 'zlib', b'garbage'))
+        assert cache.lookup('3') is None
+
+    def testStoreSettings(self):
+        assert get_store_settings({}) == {}
+        assert get_store_settings({'size_limit': 100, 'eviction_policy': 'lfu'}) == {
+            'size_limit': 100 * 1024 * 1024,
+            'eviction_policy': 'least-frequently-used',
+        }
+
+
 class SruMock(Mock):
 
     def __init__(self, **kwargs):
@@ -727,13 +1297,167 @@ def patch_sru_search(xml_response_file):
     return decorator_fn
 
 
+class FakeSruClient(object):
+    # Evaluates the CQL queries made by QueryPartitioner against a list of (MMS ID, year) tuples
+
+    name = None
+    record_no = 0
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def matches(self, query):
+        match = re.search(r'(AND|NOT) \(?alma.main_pub_date>=(\d+) AND alma.main_pub_date<=(\d+)', query)
+        if match is None:
+            return [mms_id for mms_id, _ in self.records]
+        first, last = int(match.group(2)), int(match.group(3))
+        in_range = [mms_id for mms_id, year in self.records if year is not None and first <= year <= last]
+        if match.group(1) == 'AND':
+            return in_range
+        return [mms_id for mms_id, _ in self.records if mms_id not in in_range]
+
+    def count(self, query):
+        self.queries.append(query)
+        return len(self.matches(query))
+
+    def search(self, query):
+        for mms_id in self.matches(query):
+            yield Mock(id=mms_id)
+
+
+class TestMarcXmlReader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        record = get_sample('marc_record_1.xml').split('?>', 1)[1]
+        self.collection = '<collection xmlns="http://www.loc.gov/MARC21/slim">%s%s</collection>' % (
+            record, record.replace('991416299674702204', '991416299674702205'))
+
+    def write(self, filename, data, opener=open):
+        path = os.path.join(self.dir, filename)
+        with opener(path, 'wb') as fp:
+            fp.write(data.encode('utf-8'))
+        return path
+
+    def testReadGzippedCollection(self):
+        reader = MarcXmlReader([
+            self.write('export.xml.gz', self.collection, gzip.open),
+            self.write('single.xml', get_sample('marc_record_1.xml')),
+        ])
+        records = list(reader.search('ignored'))
+
+        assert [record.id for record in records] == ['991416299674702204', '991416299674702205', '991416299674702204']
+        assert reader.num_records == 3
+        for record in records:
+            assert record.el.nsmap == {}
+            assert len(list(record.get_fields('650'))) > 0
+
+    def testListJobFromFile(self):
+        reader = MarcXmlReader([self.write('export.xml', self.collection)])
+        conf = {'vocabularies': [{'marc_code': 'noubomn'}], 'default_vocabulary': 'noubomn'}
+        ils = MagicMock(spec=Alma)
+        job = Job(sru=reader, ils=ils, **job_args(conf, parse_args(['list', 'Monstre'])))
+        job.interactivity = INTERACTIVITY_NONE
+
+        results = job.start()
+
+        assert list(results) == ['991416299674702204', '991416299674702205']
+        assert ils.get_record.call_count == 0
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testOfflineBulkEdit(self, authorize_term):
+        authorize_term.return_value = {}
+        record = get_sample('marc_record_1.xml').split('?>', 1)[1]
+        unchanged = record.replace('991416299674702204', '991416299674702206').replace('Monstre', 'Troll')
+        reader = MarcXmlReader([self.write('export.xml.gz', self.collection.replace(
+            '</collection>', unchanged + '</collection>'), gzip.open)])
+        conf = {'vocabularies': [{'marc_code': 'noubomn'}], 'default_vocabulary': 'noubomn'}
+        ils = MagicMock(spec=Alma)
+        job = Job(sru=reader, ils=ils, **job_args(conf, parse_args(['replace', 'Monstre', 'Monster'])))
+        job.show_progress = False
+
+        output = os.path.join(self.dir, 'changed.xml.gz')
+        with MarcXmlWriter(output) as writer:
+            assert job.export_records(writer) == 2
+
+        assert ils.get_record.call_count == 0
+        assert ils.put_record.call_count == 0
+
+        with gzip.open(output) as fp:
+            assert b'<collection xmlns="http://www.loc.gov/MARC21/slim">' in fp.read()
+
+        records = list(MarcXmlReader([output]).search())
+        assert [record.id for record in records] == ['991416299674702204', '991416299674702205']
+        for record in records:
+            assert record_search(record, '650', {'a': 'Monster', '2': 'noubomn'}) == 1
+            assert record_search(record, '650', {'a': 'Monstre', '2': 'noubomn'}) == 0
+
+        with open(os.path.join(self.dir, 'changed.manifest.jsonl'), encoding='utf-8') as fp:
+            manifest = [json.loads(line) for line in fp]
+        assert [entry['id'] for entry in manifest] == ['991416299674702204', '991416299674702205']
+        assert '+650 #7 $a Monster $2 noubomn\n' in manifest[0]['diff']
+
+    def testOfflineBulkEditSkipsUnchangedRecords(self):
+        reader = MarcXmlReader([self.write('export.xml', self.collection)])
+        conf = {'vocabularies': [{'marc_code': 'noubomn'}], 'default_vocabulary': 'noubomn'}
+        job = Job(sru=reader, ils=MagicMock(spec=Alma), **job_args(conf, parse_args(['list', 'Monstre'])))
+        job.show_progress = False
+
+        # Steps that cancel each other out
+        concept = Concept('650', OrderedDict([('a', 'Test'), ('2', 'noubomn')]))
+        job.steps = [AddTask(concept), DeleteTask([concept])]
+
+        output = os.path.join(self.dir, 'changed.xml')
+        with MarcXmlWriter(output) as writer:
+            assert job.export_records(writer) == 0
+        assert list(MarcXmlReader([output]).search()) == []
+
+
+class TestPartitioning(unittest.TestCase):
+
+    def setUp(self):
+        years = [1950] * 4 + [1990] * 3 + [2000] * 3 + [2010] * 5 + [None] * 2
+        self.sru = FakeSruClient([(str(n), year) for n, year in enumerate(years)])
+
+    def testSmallQueryIsNotSplit(self):
+        partitioner = QueryPartitioner(self.sru, last=2020, max_records=100)
+        assert partitioner.partitions('alma.subjects="Test"') == [('alma.subjects="Test"', 17)]
+
+    def testPartitionsAreDisjointAndComplete(self):
+        partitioner = QueryPartitioner(self.sru, last=2020, max_records=5)
+        partitions = partitioner.partitions('alma.subjects="Test"')
+
+        assert all(count <= 5 for _, count in partitions)
+        found = [mms_id for query, _ in partitions for mms_id in self.sru.matches(query)]
+        assert sorted(found) == sorted(mms_id for mms_id, _ in self.sru.records)
+        assert partitions[-1] == ('(alma.subjects="Test") NOT (alma.main_pub_date>=0 AND alma.main_pub_date<=2020)', 2)
+
+    def testTooManyResultsForSingleYear(self):
+        partitioner = QueryPartitioner(self.sru, last=2020, max_records=4)
+        with pytest.raises(TooManyResults):
+            partitioner.partitions('alma.subjects="Test"')
+
+    def testSearchDeduplicates(self):
+        partitioner = Mock()
+        partitioner.partitions.return_value = [('part1', 3), ('part2', 2)]
+        self.sru.search = lambda query: iter([Mock(id='1'), Mock(id='2'), Mock(id='3')] if query == 'part1'
+                                             else [Mock(id='3'), Mock(id='4')])
+
+        for workers in [1, 2]:
+            client = PartitionedSruClient(self.sru, workers=workers, partitioner=partitioner)
+            assert [record.id for record in client.search('query')] == ['1', '2', '3', '4']
+            assert client.num_records == 5
+
+
 class TestJob(unittest.TestCase):
 
     def setUp(self):
         MockAlma = MagicMock(spec=Alma, spec_set=True)
         self.alma = MockAlma('eu', 'dummy', get_cache_mock())
 
-    def runJob(self, sru_response, vocabulary, args):
+    def runJob(self, sru_response, vocabulary, args, workers=1, journal=None, match_processes=1, verify=False):
 
         patched_sru = SruClient('http://example.com', get_cache_mock())
         patched_sru.request = MagicMock(name='request')
@@ -749,6 +1473,10 @@ class TestJob(unittest.TestCase):
         self.job = Job(sru=patched_sru, ils=self.alma, **job_args(conf, parse_args(args)))
         # self.job.dry_run = True
         self.job.interactivity = INTERACTIVITY_NONE
+        self.job.workers = workers
+        self.job.journal = journal
+        self.job.match_processes = match_processes
+        self.job.verify = verify
 
         # Job(self.sru, self.alma, voc, tag, term, new_term, new_tag)
         return self.job.start()
@@ -834,10 +1562,10 @@ class TestJob(unittest.TestCase):
 
         def put_record(record, **kwargs):
             if '990715687274702201' == record.id:
-                assert 'identifier_13245' not in record.xml()
+                assert b'identifier_13245' not in record.xml()
                 return get_sample('bib_990715687274702201.xml',)
             if '990100089184702201' == record.id:
-                assert 'identifier_13245' not in record.xml()
+                assert b'identifier_13245' not in record.xml()
                 return get_sample('bib_990100089184702201.xml',)
 
         self.alma.put_record.side_effect = put_record
@@ -872,6 +1600,429 @@ class TestJob(unittest.TestCase):
         # assert 'Kjemi' == f650[0].findtext('subfield[@code="x"]')
         # assert f650[0].find('subfield[@code="0"]') is None
 
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testRecordsThatWouldNotChangeAreNotFetched(self, authorize_term):
+        authorize_term.return_value = {}
+        results = self.runJob('sru_sample_response_1.xml', 'tekord',
+                              ['replace', 'Geologi', 'Geologi'])
+
+        assert len(results) == 0
+        assert self.alma.get_record.call_count == 0
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testConcurrentPipeline(self, authorize_term):
+        authorize_term.return_value = {}
+        samples = {
+            '990715687274702201': get_sample('bib_990715687274702201.xml'),
+            '990100089184702201': get_sample('bib_990100089184702201.xml'),
+        }
+        self.alma.get_record.side_effect = lambda record_id: Bib(samples[record_id])
+
+        results = self.runJob('sru_sample_response_1.xml', 'tekord',
+                              ['replace', 'Geologi', 'TestReplace'], workers=4)
+
+        assert len(results) == 2
+        assert self.alma.get_record.call_count == 2
+        assert self.alma.put_record.call_count == 2
+        assert self.job.records_changed == 2
+        for args, kwargs in self.alma.put_record.call_args_list:
+            assert b'TestReplace' in args[0].xml()
+            assert kwargs['interactive'] is False
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testMatchingInWorkerProcesses(self, authorize_term):
+        authorize_term.return_value = {}
+        for args in [['replace', 'Statistiske modeller', 'Test'], ['list', 'Statistiske modeller'],
+                     ['--grep', 'biologi', 'remove', 'Statistiske modeller']]:
+            expected = self.runJob('sru_sample_response_1.xml', 'noubomn', args)
+            results = self.runJob('sru_sample_response_1.xml', 'noubomn', args, match_processes=2)
+            assert list(results) == list(expected)
+            assert len(results) > 0
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testBatchJob(self, authorize_term):
+        authorize_term.return_value = {}
+        # Make Bibs API responses from the search results
+        samples = {
+            record.id: '<bib><mms_id>%s</mms_id>%s</bib>' % (record.id, etree.tounicode(record.el))
+            for _, record in SruPage(get_sample('sru_sample_response_1.xml'))
+        }
+        self.alma.get_record.side_effect = lambda record_id: Bib(samples[record_id])
+
+        sru = SruClient('http://example.com', get_cache_mock())
+        sru.request = MagicMock(return_value=get_sample('sru_sample_response_1.xml'))
+        conf = {'vocabularies': [{'marc_code': 'tekord'}], 'default_vocabulary': 'tekord'}
+        jobs = [
+            Job(sru=sru, ils=self.alma, **job_args(conf, parse_args(args)))
+            for args in [['replace', 'Geologi', 'Geofag'], ['remove', '650 #7 $$a Geostatistikk $$2 noubomn'],
+                         ['replace', 'Something else', 'Test']]
+        ]
+        self.job = BatchJob(jobs, sru=sru, ils=self.alma)
+        self.job.interactivity = INTERACTIVITY_NONE
+        results = self.job.start()
+
+        assert len(results) == 3
+        assert sru.request.call_count == 3
+        assert self.alma.get_record.call_count == 3
+        assert self.alma.put_record.call_count == 3
+        records = [args[0].marc_record for args, kwargs in self.alma.put_record.call_args_list]
+        assert [record_search(record, '650', {'a': 'Geofag', '2': 'tekord'}) for record in records].count(1) == 2
+        for record in records:
+            assert record_search(record, '650', {'a': 'Geostatistikk', '2': 'noubomn'}) == 0
+
+        # The batch job has the same state as other jobs, so inherited paths work too
+        assert self.job.job_name is not None
+        search_results = [record for _, record in SruPage(get_sample('sru_sample_response_1.xml'))]
+        assert len([record for record in search_results if self.job.select_record(record)]) == 3
+
+    @patch('almar.authorities.Vocabulary.authorize_term', autospec=True)
+    def testBatchJobReadsFilesOnce(self, authorize_term):
+        authorize_term.return_value = {}
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'export.xml')
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('<collection>%s</collection>' % ''.join(
+                etree.tounicode(record.el) for _, record in SruPage(get_sample('sru_sample_response_1.xml'))
+            ))
+
+        reader = MarcXmlReader([path])
+        conf = {'vocabularies': [{'marc_code': 'tekord'}], 'default_vocabulary': 'tekord'}
+        jobs = [
+            Job(sru=reader, ils=self.alma, **job_args(conf, parse_args(['--file', path] + args)))
+            for args in [['replace', 'Geologi', 'Geofag'], ['remove', '650 #7 $$a Geostatistikk $$2 noubomn'],
+                         ['replace', 'Something else', 'Test']]
+        ]
+        self.job = BatchJob(jobs, sru=reader, ils=self.alma)
+        with patch.object(MarcXmlReader, 'read', side_effect=MarcXmlReader.read) as read:
+            records = self.job.find_records()
+
+        assert read.call_count == 1
+        assert len(records) == 3
+
+    def testReadMapping(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        with open(os.path.join(tmp_dir, 'mapping.csv'), 'w', encoding='utf-8') as fp:
+            fp.write('# source,targets\nMønstre,Mønster\n650 Atferd,Oppførsel,651 Oslo\n\nKretser,,\n')
+        with open(os.path.join(tmp_dir, 'mapping.yml'), 'w', encoding='utf-8') as fp:
+            fp.write('- source: Mønstre\n  target: Mønster\n- source: 650 Atferd\n  targets: [Oppførsel, 651 Oslo]\n'
+                     '- source: Kretser\n')
+
+        expected = [
+            ['replace', 'Mønstre', 'Mønster'],
+            ['replace', '650 Atferd', 'Oppførsel', '651 Oslo'],
+            ['remove', 'Kretser'],
+        ]
+        assert read_mapping(os.path.join(tmp_dir, 'mapping.csv')) == expected
+        assert read_mapping(os.path.join(tmp_dir, 'mapping.yml')) == expected
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testResumeFromJournal(self, authorize_term):
+        authorize_term.return_value = {}
+        self.alma.get_record.side_effect = lambda record_id: Bib(get_sample('bib_%s.xml' % record_id))
+        job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_dir)
+
+        journal = Journal.create(job_dir, 'testjob', ['replace', 'Geologi', 'TestReplace'])
+        journal.set_candidates(['990715687274702201', '990100089184702201'])
+        journal.set_status('990715687274702201', 'put')
+
+        results = self.runJob('sru_sample_response_1.xml', 'tekord',
+                              ['replace', 'Geologi', 'TestReplace'], journal=Journal.find(job_dir, 'test'))
+
+        assert list(results) == ['990100089184702201']
+        assert self.job.sru.request.call_count == 0
+        self.alma.get_record.assert_called_once_with('990100089184702201')
+
+        journal = Journal.find(job_dir, 'testjob')
+        assert journal.status['990100089184702201'] == 'put'
+        assert journal.pending() == []
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testRecordsThatEndUpUnchangedAreNotStored(self, authorize_term):
+        authorize_term.return_value = {}
+        self.alma.get_record.side_effect = lambda record_id: Bib(get_sample('bib_%s.xml' % record_id))
+        self.runJob('sru_sample_response_1.xml', 'tekord', ['replace', 'Geologi', 'TestReplace'])
+
+        # Steps that cancel each other out
+        concept = Concept('650', OrderedDict([('a', 'Test'), ('2', 'noubomn')]))
+        self.job.steps = [AddTask(concept), DeleteTask([concept])]
+        self.alma.put_record.reset_mock()
+        record = Bib(get_sample('bib_990715687274702201.xml'))
+
+        assert self.job.update_record(record, {'current': 1, 'total': 1}) == 0
+        assert len(record.marc_record.changes) == 2
+        assert self.alma.put_record.call_count == 0
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    def testVerifyCachedRecords(self, authorize_term):
+        authorize_term.return_value = {}
+        fresh_samples = {
+            # Someone else has changed the title of this one...
+            '990715687274702201': get_sample('bib_990715687274702201.xml').replace('scientists<', 'science<'),
+            # ...and already fixed this one
+            '990100089184702201': get_sample('bib_990100089184702201.xml').replace('>Geologi<', '>TestReplace<'),
+        }
+
+        def get_record(record_id, fresh=False):
+            record = Bib(fresh_samples[record_id] if fresh else get_sample('bib_%s.xml' % record_id))
+            record.cached = not fresh
+            return record
+
+        for workers in [1, 4]:
+            self.alma.reset_mock()
+            self.alma.get_record.side_effect = get_record
+            results = self.runJob('sru_sample_response_1.xml', 'tekord',
+                                  ['replace', 'Geologi', 'TestReplace'], workers=workers, verify=True)
+
+            assert len(results) == 2
+            assert self.alma.get_record.call_count == 4
+            self.alma.get_record.assert_any_call('990715687274702201', fresh=True)
+
+            # The steps were run again on the new version of the first record
+            assert self.alma.put_record.call_count == 1
+            stored = self.alma.put_record.call_args[0][0]
+            assert stored.id == '990715687274702201'
+            assert b'TestReplace' in stored.xml()
+            assert b'environmental science<' in stored.xml()
+            assert self.job.records_changed == 1
+
+        # Records that weren't changed in Alma are stored as they are
+        record = get_record('990715687274702201')
+        self.job.modify_record(record, None)
+        assert not self.job.was_changed(record, get_record('990715687274702201'))
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.job_dir)
+
+    def testReload(self):
+        journal = Journal.create(self.job_dir, 'abc123', ['remove', 'Test'])
+        assert journal.candidates is None
+        journal.set_candidates(['1', '2', '3', '4'])
+        journal.set_status('1', 'fetched')
+        journal.set_status('1', 'unchanged')
+        journal.set_status('2', 'modified', diff=['- æ', '+ ø'])
+        journal.set_status('2', 'put')
+        journal.set_status('3', 'failed')
+
+        # Simulate a crash while writing an entry
+        with open(journal.path, 'a', encoding='utf-8') as fp:
+            fp.write('{"event": "record", "id": "4", "stat')
+
+        journal = Journal(journal.path)
+        assert journal.jobname == 'abc123'
+        assert journal.argv == ['remove', 'Test']
+        assert journal.pending() == ['3', '4']
+
+    def testFileIsCreatedOnFirstEntry(self):
+        # Jobs that never get to process any records don't leave a journal behind
+        job_dir = os.path.join(self.job_dir, 'jobs')
+        journal = Journal.create(job_dir, 'abc123', ['remove', 'Test'])
+        assert not os.path.exists(job_dir)
+
+        journal.set_candidates(['1'])
+        journal = Journal.find(job_dir, 'abc')
+        assert journal.argv == ['remove', 'Test']
+        assert journal.pending() == ['1']
+
+    def testFind(self):
+        Journal.create(self.job_dir, 'abc123', []).set_candidates([])
+        Journal.create(self.job_dir, 'abd456', []).set_candidates([])
+
+        assert Journal.find(self.job_dir, 'abc').jobname == 'abc123'
+        assert Journal.find(self.job_dir, 'ab') is None
+        assert Journal.find(self.job_dir, 'x') is None
+
+
+class TestRollback(unittest.TestCase):
+
+    def setUp(self):
+        job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_dir)
+        self.journal = Journal.create(job_dir, 'abc123', ['remove', 'Test'])
+        self.preimages = PreimageStore(self.journal.preimages_path)
+        self.originals = {}
+        self.current = {}
+
+        # Simulate a job storing two records
+        sample = get_sample('bib_990705558424702201.xml')
+        for mms_id in ['1', '2']:
+            original = sample.replace('990705558424702201', mms_id)
+            bib = Bib(original)
+            AddTask(Concept('650', OrderedDict([('a', 'Test'), ('2', 'noubomn')]))).run(bib.marc_record)
+            self.originals[mms_id] = original
+            self.current[mms_id] = bib.xml()
+            self.journal.set_status(mms_id, PUT, preimage=self.preimages.put(original),
+                                    hash=bib.marc_record.content_hash())
+
+        # ...and someone changing the second record afterwards
+        self.current['2'] = self.current['2'].replace(b'>Test<', b'>Changed<')
+
+        self.ils = Mock()
+        self.ils.get_record.side_effect = lambda mms_id, fresh: Bib(self.current[mms_id])
+        self.ils.put_record.return_value = True
+
+    def testRollback(self):
+        rollback = Rollback(Journal(self.journal.path), self.preimages, self.ils, workers=2, show_progress=False)
+        statuses = rollback.start()
+
+        assert statuses == {ROLLED_BACK: 1, CONFLICT: 1}
+        assert self.ils.put_record.call_count == 1
+        restored = self.ils.put_record.call_args[0][0]
+        assert restored.id == '1'
+        assert restored.orig_xml.decode('utf-8') == self.originals['1']
+
+        # Only the conflict is left, and it's only rolled back when forced
+        journal = Journal(self.journal.path)
+        assert journal.status == {'1': ROLLED_BACK, '2': CONFLICT}
+        statuses = Rollback(journal, self.preimages, self.ils, force=True, show_progress=False).start()
+        assert statuses == {ROLLED_BACK: 1}
+        assert self.ils.put_record.call_args[0][0].id == '2'
+
+    def testPreimagesAreContentAddressed(self):
+        assert self.preimages.put(self.originals['1']) == self.journal.preimages['1'][0]
+        assert self.preimages.get(self.journal.preimages['2'][0]).decode('utf-8') == self.originals['2']
+
+
+@pytest.mark.skipif(aiohttp is None, reason='aiohttp not installed')
+class TestAsyncEngine(unittest.TestCase):
+
+    @staticmethod
+    def stub_app(puts):
+        # Stand-in for the SRU service, the Bibs API and the ID lookup service
+        rejected = set()
+        bibs = {
+            '990715687274702201': get_sample('bib_990715687274702201.xml'),
+            '990100089184702201': get_sample('bib_990100089184702201.xml'),
+        }
+
+        async def sru(request):
+            return web.Response(text=get_sample('sru_sample_response_1.xml'), content_type='application/xml')
+
+        async def get_bib(request):
+            return web.Response(text=bibs[request.match_info['mms_id']], content_type='application/xml')
+
+        async def put_bib(request):
+            body = await request.text()
+            if request.match_info['mms_id'] not in rejected:
+                # The first attempt is rejected because of the API quota
+                rejected.add(request.match_info['mms_id'])
+                return web.Response(status=429, text='PER_SECOND_THRESHOLD', headers={'Retry-After': '2'})
+            puts.append(body)
+            return web.Response(text=body, content_type='application/xml')
+
+        async def authorize(request):
+            return web.json_response({'id': 'REAL123'} if request.query['term'] == 'TestReplace' else {})
+
+        app = web.Application()
+        app.router.add_get('/sru', sru)
+        app.router.add_get('/almaws/v1/bibs/{mms_id}', get_bib)
+        app.router.add_put('/almaws/v1/bibs/{mms_id}', put_bib)
+        app.router.add_get('/authorize', authorize)
+        return app
+
+    def testReplaceJob(self):
+        puts = []
+        clock = FakeClock()
+
+        async def run_job():
+            async with TestServer(self.stub_app(puts)) as server, create_session() as session:
+                base_url = str(server.make_url(''))
+                vocab = AsyncVocabulary('tekord', session, base_url + '/authorize?term={term}&tag={tag}')
+                conf = {'vocabularies': [{'marc_code': 'tekord'}], 'default_vocabulary': 'tekord'}
+                jargs = job_args(conf, parse_args(['replace', 'Geologi', 'TestReplace']))
+                jargs['authorities'] = AsyncAuthorities({'tekord': vocab})
+
+                sru = AsyncSruClient(base_url + '/sru', get_cache_mock(), session)
+                scheduler = AsyncRequestScheduler(session, rate=10, clock=clock, sleep=clock.async_sleep)
+                alma = AsyncAlma('eu', 'key', get_cache_mock(), session, scheduler=scheduler)
+                alma.base_url = base_url + '/almaws/v1'
+
+                job = AsyncJob(sru=sru, ils=alma, concurrency=4, **jargs)
+                results = await job.start()
+                return job, results
+
+        job, results = asyncio.run(run_job())
+
+        assert job.target_concepts[0].sf['0'] == 'REAL123'
+        assert sorted(results) == ['990100089184702201', '990715687274702201']
+        assert job.records_changed == 2
+        assert len(puts) == 2
+        for body in puts:
+            assert 'TestReplace' in body
+
+        # Both rejected PUTs were retried after pausing the bucket
+        assert clock.sleeps.count(2.0) >= 1
+        assert clock.now >= 2.0
+
+    def testPutRecordErrors(self):
+        async def put_record(error):
+            scheduler = Mock()
+            scheduler.put.side_effect = error
+            alma = AsyncAlma('eu', 'key', get_cache_mock(), None, scheduler=scheduler)
+            return await alma.put_record(Bib(get_sample('bib_990715687274702201.xml')))
+
+        # Failures are logged and reported like with the blocking client, instead of aborting the job
+        for error in [aiohttp.ClientConnectionError('Connection reset'), asyncio.TimeoutError()]:
+            assert asyncio.run(put_record(error)) is False
+
+    def testMultiPageSearch(self):
+        async def sru(request):
+            sample = 'sru_sample_response_3.xml' if request.query['startRecord'] == '2' else 'sru_sample_response_2.xml'
+            return web.Response(text=get_sample(sample), content_type='application/xml')
+
+        async def search():
+            app = web.Application()
+            app.router.add_get('/sru', sru)
+            async with TestServer(app) as server, create_session() as session:
+                client = AsyncSruClient(str(server.make_url('/sru')), get_cache_mock(), session)
+                return [record.id async for record in client.search('alma.subjects=="test"')]
+
+        assert asyncio.run(search()) == ['990314778524702201', '991343643254702201']
+
+    def testAuthoritiesAreCached(self):
+        lookups = []
+
+        async def authorize(request):
+            lookups.append(request.query['term'])
+            return web.json_response({'id': 'REAL123'} if request.query['term'] == 'Found' else {'id': None})
+
+        def stub_app():
+            app = web.Application()
+            app.router.add_get('/authorize', authorize)
+            return app
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        store = Cache(cache_dir)
+        self.addCleanup(store.close)
+
+        async def authorize_concepts(terms):
+            async with TestServer(stub_app()) as server, create_session() as session:
+                base_url = str(server.make_url(''))
+                vocab = AsyncVocabulary('tekord', session, base_url + '/authorize?term={term}&tag={tag}')
+                authorities = AsyncAuthorities({'tekord': vocab}, store)
+                concepts = [Concept('650', OrderedDict([('a', term), ('2', 'tekord')])) for term in terms]
+                await authorities.prefetch(concepts)
+                for concept in concepts:
+                    await authorities.authorize_concept(concept)
+                return concepts, authorities
+
+        concepts, authorities = asyncio.run(authorize_concepts(['Found', 'Missing', 'Found']))
+        assert [concept.sf.get('0') for concept in concepts] == ['REAL123', None, 'REAL123']
+        assert sorted(lookups) == ['Found', 'Missing']
+
+        # Found and not found terms are both cached, with the same keys as the blocking client
+        concepts, _ = asyncio.run(authorize_concepts(['Found', 'Missing']))
+        assert concepts[0].sf['0'] == 'REAL123'
+        assert len(lookups) == 2
+        assert authorities.cache.get('tekord:650:Found') == {'id': 'REAL123'}
+
 
 class TestAlmar(unittest.TestCase):
 
@@ -897,7 +2048,7 @@ class TestAlmar(unittest.TestCase):
 
     @classmethod
     def conf_obj(cls):
-        return yaml.load(cls.conf())
+        return yaml.safe_load(cls.conf())
 
     @staticmethod
     def sru_search_mock(*args, **kwargs):
@@ -919,6 +2070,53 @@ class TestAlmar(unittest.TestCase):
 
         assert alma.get_record.call_count == 14
 
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    @patch('almar.almar.Alma', autospec=True, spec_set=True)
+    @patch_sru_search('sru_sample_response_1.xml')
+    def testMainResume(self, sru, MockAlma, mock_authorize_term):
+        term = 'Statistiske modeller'
+        mock_authorize_term.return_value = {'id': 'REAL030697'}
+        alma = MockAlma.return_value
+        sample = get_sample('bib_990705558424702201.xml')
+
+        def get_record(record_id):
+            if alma.get_record.call_count == 4:
+                raise RuntimeError('Connection lost')
+            return Bib(sample.replace('990705558424702201', record_id))
+
+        alma.get_record.side_effect = get_record
+        job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_dir)
+
+        run(self.conf_obj(), get_cache_mock(), ['-e test_env', '-n', 'remove', term], job_dir=job_dir)
+        assert alma.get_record.call_count == 4
+
+        jobname = os.listdir(job_dir)[0][:10]
+        run(self.conf_obj(), get_cache_mock(), ['--resume', jobname], job_dir=job_dir)
+        sru.request.assert_called_once()
+        assert alma.get_record.call_count == 4 + 11
+
+        # Without a job dir there's nothing to resume from
+        with pytest.raises(SystemExit):
+            run(self.conf_obj(), get_cache_mock(), ['--resume', jobname], job_dir=None)
+
+    @patch.object(Vocabulary, 'authorize_term', autospec=True)
+    @patch('almar.almar.Alma', autospec=True, spec_set=True)
+    @patch_sru_search('sru_sample_response_1.xml')
+    def testMainInterrupted(self, sru, MockAlma, mock_authorize_term):
+        mock_authorize_term.return_value = {'id': 'REAL030697'}
+        alma = MockAlma.return_value
+        alma.get_record.side_effect = KeyboardInterrupt
+        job_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_dir)
+
+        with self.assertLogs(level='INFO') as logs, pytest.raises(KeyboardInterrupt):
+            run(self.conf_obj(), get_cache_mock(), ['-e test_env', '-n', 'remove', 'Statistiske modeller'],
+                job_dir=job_dir)
+
+        jobname = os.listdir(job_dir)[0][:10]
+        assert 'The job can be resumed with: almar --resume %s' % jobname in logs.output[-1]
+
     @patch.object(Vocabulary, 'authorize_term', autospec=True)
     @patch('almar.almar.Alma', autospec=True, spec_set=True)
     @patch_sru_search('sru_sample_response_1.xml')
@@ -975,7 +2173,7 @@ class TestAlmar(unittest.TestCase):
         run(self.conf_obj(), get_cache_mock(), ['-e test_env', '-n', 'list', term])
         sru.request.assert_called_once_with(
             'alma.authority_vocabulary="%s" AND alma.subjects="%s"' % ('noubomn', term), 1)
-        assert alma.get_record.call_count == 1
+        assert alma.get_record.call_count == 0  # The records from SRU are enough
         assert alma.put_record.call_count == 0
 
     @responses.activate
@@ -1054,6 +2252,25 @@ class TestArgumentParsing(unittest.TestCase):
         assert jargs['source_concepts'][0].tag == '650'
         assert jargs['source_concepts'][0].term == 'Sekvensering'
 
+    def test_file_needs_a_term(self):
+        # Records from a file are not filtered by the query, so that would select every record
+        for argv in [['--file', 'dump.xml', 'add', 'Test'],
+                     ['--file', 'dump.xml', '--add', 'Test'],
+                     ['--file', 'dump.xml', '--cql', 'alma.mms_id=1', 'remove', 'Test']]:
+            with pytest.raises(SystemExit):
+                parse_args(argv, None)
+
+        args = parse_args(['--file', 'dump.xml', '--rem', 'Old', '--add', 'Test'], None)
+        assert args.action == 'custom'
+
+    def test_batch_rejects_cql(self):
+        # Each job in a batch searches for its own terms, so a global query would be ignored
+        with pytest.raises(SystemExit):
+            parse_args(['--cql', 'alma.mms_id=1', 'batch', 'mapping.csv'], None)
+
+        args = parse_args(['--grep', 'some text', 'batch', 'mapping.csv'], None)
+        assert args.action == 'batch'
+
     def test_unicode_input(self):
         args = parse_args(['replace', 'Byer : Økologi', 'Byøkologi'], default_env='test_env')
 